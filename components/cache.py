@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# On-disk cache of precomputed NumPy arrays. Arrays are saved as .npy files named after a hash of the
+# parameters used to build them, so changing the parameters simply builds (and caches) a new array.
+# Cached arrays are memory-mapped read-only. When the cache directory can't be written, arrays are
+# still built and returned, just not saved.
+
+import os
+import hashlib
+import numpy as np
+
+CACHE_DIR_NAME = 'launchpad-player'
+
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, CACHE_DIR_NAME)
+
+def get_key(*params):
+    return hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:16]
+
+def get_path(name, key):
+    return os.path.join(get_cache_dir(), f"{name}-{key}.npy")
+
+def load_array(name, key, build):
+    path = get_path(name, key)
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+
+    array = build()
+    try:
+        save_array(path, array)
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return array
+
+def save_array(path, array):
+    # Written to a temporary file first, so other processes never load a partial array
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def load_arrays(name, key, array_names):
+    # Arrays saved together by save_arrays, memory-mapped, or None if any of them is missing
+    try:
+        return {array_name: np.load(get_path(f"{name}-{array_name}", key), mmap_mode='r') for array_name in array_names}
+    except (OSError, ValueError):
+        return None
+
+def save_arrays(name, key, arrays):
+    # Returns False if the arrays could not be saved
+    try:
+        for array_name, array in arrays.items():
+            save_array(get_path(f"{name}-{array_name}", key), array)
+    except (OSError, ValueError):
+        return False
+    return True
@@ -9,7 +9,7 @@ import time
 import cairo
 import layout
 
-from .colors import get_color_from_note
+from .colors import get_color_from_note, hsv_to_rgb
 from .musical_info import MusicDefs
 
 class CircleOfFifthsElement(layout.root.LayoutElement):
@@ -22,20 +22,22 @@ class CircleOfFifthsElement(layout.root.LayoutElement):
         self.size = layout.datatypes.Point(width, height)
 
         self.use_fuzzy = True
+        # Draw the chord of every MIDI channel separately, inside the circle
+        self.show_channels = True
 
     def get_minimum_size(self, ctx):
         return self.size
 
     def render(self, rect, ctx):
         xpos, ypos, width, height = rect.get_data()
-        notes_in_scale = self.music_info.notes_in_scale
-        root_note = self.music_info.root_note % 12
-        notes_in_scale = self.music_info.notes_in_scale
-        pitch_classes = self.music_info.fuzzy_pitch_classes if self.use_fuzzy else self.music_info.pitch_classes
-        chord_color = self.music_info.getChordColor()
+        state = self.music_info.state
+        root_note = state.root_note % 12
+        notes_in_scale = state.notes_in_scale
+        pitch_classes = state.fuzzy_pitch_classes if self.use_fuzzy else state.pitch_classes
+        chord_color = state.chord_color
         chord_color_dark = [v * 0.6 for v in chord_color]
-        chord_note = self.music_info.chord_note
-        chord = self.music_info.chord
+        chord_note = state.chord_note
+        chord = state.chord
 
         cx = xpos + width / 2.
         cy = ypos + height / 2.
@@ -140,6 +142,31 @@ class CircleOfFifthsElement(layout.root.LayoutElement):
                     ctx.line_to(nx[n2], ny[n2])
                     ctx.stroke()
 
+        if self.show_channels:
+            # One polygon per channel playing, each one a bit further inside, with a dot on its chord root
+            channel_chords = state.channel_chords
+            channel_chord_notes = self.music_info.get_channel_analysis(state)[0]
+            channels = [channel for channel in range(len(channel_chords)) if channel_chords[channel]]
+            for i, channel in enumerate(channels):
+                cr_channel = cr - 25. - 6. * i
+                notes = [(n * 7) % 12 for n in range(12) if channel_chords[channel] & (1 << ((n * 7) % 12))]
+                px = [cx + cr_channel * math.sin(2. * math.pi * ((n * 7) % 12) / 12.) for n in notes]
+                py = [cy - cr_channel * math.cos(2. * math.pi * ((n * 7) % 12) / 12.) for n in notes]
+
+                ctx.set_source_rgb(*hsv_to_rgb(channel * 360. / len(channel_chords), 0.8, 0.8))
+                ctx.set_line_width(3.0)
+                ctx.set_line_cap(cairo.LINE_CAP_ROUND)
+                ctx.move_to(px[-1], py[-1])
+                for x, y in zip(px, py):
+                    ctx.line_to(x, y)
+                ctx.stroke()
+
+                channel_chord_note = channel_chord_notes[channel]
+                if channel_chord_note >= 0:
+                    angle = 2. * math.pi * ((channel_chord_note * 7) % 12) / 12.
+                    ctx.arc(cx + cr_channel * math.sin(angle), cy - cr_channel * math.cos(angle), 5., 0, 2. * math.pi)
+                    ctx.fill()
+
         for n in range(12):
             is_pressed = pitch_classes[n]
 
@@ -172,7 +199,7 @@ class CircleOfFifthsElement(layout.root.LayoutElement):
                 ctx.set_line_width(1.0)
                 ctx.stroke()
 
-            label = self.music_info.note_names[n % 12]
+            label = state.note_names[n % 12]
             ctx.set_source_rgb(0.1, 0.1, 0.1)
             ctx.select_font_face("monospace", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
             ctx.set_font_size(note_radius + 2)
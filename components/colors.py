@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import math
+import numpy as np
 
 # See: https://sashat.me/2017/01/11/list-of-20-simple-distinct-colors/
 COLORS_RGB = [
@@ -148,3 +149,23 @@ def rgb_to_lab(r, g, b):
     z = z**(1./3.) if (z > 0.008856) else (7.787 * z) + 16/116.0;
 
     return [(116. * y) - 16., 500. * (x - y), 200. * (y - z)]
+
+def lab_to_rgb_array(l, a, b):
+    # Same as lab_to_rgb(), but works element-wise on NumPy arrays and returns an (..., 3) array
+    y = (l + 16.) / 116.
+    x = a / 500. + y
+    z = y - b / 200.
+
+    x = 0.95047 * np.where(x * x * x > 0.008856, x * x * x, (x - 16./116.) / 7.787)
+    y = 1.00000 * np.where(y * y * y > 0.008856, y * y * y, (y - 16./116.) / 7.787)
+    z = 1.08883 * np.where(z * z * z > 0.008856, z * z * z, (z - 16./116.) / 7.787)
+
+    rgb = np.stack([
+        x *  3.2406 + y * -1.5372 + z * -0.4986,
+        x * -0.9689 + y *  1.8758 + z *  0.0415,
+        x *  0.0557 + y * -0.2040 + z *  1.0570,
+    ], axis=-1)
+
+    rgb = np.where(rgb > 0.0031308, 1.055 * (np.maximum(rgb, 0.0031308)**(1./2.4)) - 0.055, 12.92 * rgb)
+
+    return np.clip(rgb, 0., 1.)
@@ -37,11 +37,12 @@ class DiagramOfThirdsElement(layout.root.LayoutElement):
 
     def render(self, rect, ctx):
         xpos, ypos, width, height = rect.get_data()
-        notes_in_scale = self.music_info.notes_in_scale
-        pitch_classes = self.music_info.fuzzy_pitch_classes if self.use_fuzzy else self.music_info.pitch_classes
-        chord_color = self.music_info.getChordColor()
+        state = self.music_info.state
+        notes_in_scale = state.notes_in_scale
+        pitch_classes = state.fuzzy_pitch_classes if self.use_fuzzy else state.pitch_classes
+        chord_color = state.chord_color
         chord_color_dark = [v * 0.6 for v in chord_color]
-        chord_note = self.music_info.chord_note
+        chord_note = state.chord_note
 
         note_radius = 12
         base_y = ypos + height - self.border_vgap - note_radius
@@ -106,7 +107,7 @@ class DiagramOfThirdsElement(layout.root.LayoutElement):
                 y = base_y - y_step_height * y_steps
 
                 if n % 12 == chord_note:
-                    if self.music_info.keys_pressed[n]:
+                    if state.keys_pressed[n]:
                         ctx.set_line_width(note_radius * 5.0)
                     else:
                         ctx.set_line_width(note_radius * 4.5)
@@ -152,7 +153,7 @@ class DiagramOfThirdsElement(layout.root.LayoutElement):
             y_steps = ((n * 7 + self.central_voffset) % 24)
             y = base_y - y_step_height * y_steps
 
-            key_pressed = self.music_info.keys_pressed[n]
+            key_pressed = state.keys_pressed[n]
 
             if notes_in_scale[n % 12]:
                 r = note_radius
@@ -184,14 +185,14 @@ class DiagramOfThirdsElement(layout.root.LayoutElement):
             ctx.stroke()
 
             is_root_note = False
-            if (n % 12 == self.music_info.root_note % 12):
+            if (n % 12 == state.root_note % 12):
                 is_root_note = True
                 ctx.set_source_rgb(0., 0., 0.)
                 ctx.set_line_width(1.0)
                 ctx.arc(x, y, r + 6., 0, 2. * math.pi)
                 ctx.stroke()
 
-            label = self.music_info.note_names[n % 12]
+            label = state.note_names[n % 12]
             ctx.set_source_rgb(0.1, 0.1, 0.1)
             ctx.select_font_face("monospace", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
             ctx.set_font_size(r + 2)
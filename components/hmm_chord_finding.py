@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Beat level chord finding with a HMM. The hidden states are every chord type of MusicalInfo.CHORD_NAMES on
+# every root note, plus a "no chord" state, and the observations are the pitch classes (12-bit sets) of
+# every beat. Unlike MusicalInfo, which finds the chord greedily from the notes being held, a chord is
+# kept over the beats where some of its notes are missing or some passing notes are played.
+
+import numpy as np
+
+from .musical_info import MusicalInfo
+from .hmm_key_finding import StateChangeProbabilities, viterbi_structured
+
+# Probability that a note of the chord is played in a beat, and that any other note is played
+PROB_CHORD_NOTE = 0.9
+PROB_OTHER_NOTE = 0.1
+
+PROB_SAME_CHORD = 0.6
+
+class ChordEmissionProbabilities():
+    def __init__(self, prob_chord_note=PROB_CHORD_NOTE, prob_other_note=PROB_OTHER_NOTE):
+        # State n = chord type * 12 + root note, with the chord types in the order of MusicalInfo.CHORD_NAMES
+        # and the roots in chromatic order. The last state is "no chord". Ties go to the lowest state, so
+        # symmetric chords (augmented, diminished 7th), which have the same notes on several roots, get the
+        # lowest chromatic root, not the one MusicalInfo would choose around the circle of fifths from the
+        # root of the key.
+        self.chord_types = np.repeat(np.arange(len(MusicalInfo.CHORD_NAMES), dtype=np.int16), 12)
+        self.chord_notes = np.tile(np.arange(12, dtype=np.int8), len(MusicalInfo.CHORD_NAMES))
+        chord_signatures = [chord_info[0][note] for chords_list in MusicalInfo.CHORDS_INFO for chord_info in chords_list for note in range(12)]
+
+        self.chord_types = np.append(self.chord_types, np.int16(-1))
+        self.chord_notes = np.append(self.chord_notes, np.int8(-1))
+        chord_signatures.append(0)
+
+        templates = (np.array(chord_signatures)[:, None] >> np.arange(12)) & 1
+        self.frequencies = np.where(templates, prob_chord_note, prob_other_note)
+        self.shape = (len(chord_signatures), 2**12)
+
+    def get_log_emissions(self, pitch_classes):
+        # (T) 12-bit pitch class sets -> (T x M) log emission probabilities
+        observations = (np.asarray(pitch_classes, dtype=np.int64)[:, None] >> np.arange(12)) & 1
+        return observations @ np.log(self.frequencies).T + (1 - observations) @ np.log(1. - self.frequencies).T
+
+def find_chords(pitch_classes_per_beat, prob_same_chord=PROB_SAME_CHORD):
+    # Smoothed chord track: chord type (index in MusicalInfo.CHORD_NAMES, or -1) and root note (or -1)
+    # of every beat, as arrays
+    b = ChordEmissionProbabilities()
+    a = StateChangeProbabilities(prob_same_chord, b.shape[0])
+    log_b = b.get_log_emissions(pitch_classes_per_beat)
+    log_initial_distribution = np.log(np.array([1. / b.shape[0]] * b.shape[0]))
+    states = viterbi_structured(log_b, a, log_initial_distribution)
+    return b.chord_types[states], b.chord_notes[states]
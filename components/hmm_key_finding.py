@@ -2,10 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import math
+import json
 import functools
 import operator
 import numpy as np
 
+try:
+    from . import cache
+except ImportError:
+    import cache
+
 NUM_NOTES = 12
 NUM_MODES = 2
 
@@ -168,11 +174,18 @@ TEST_PITCH_HISTOGRAMS = [
         [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 ]
 
+# Offset of the tonic of each mode in the major scale of the same pitch classes (major, natural minor)
+MUSIC_MODE_TONICS = [0, 9]
+
 class StateChangeProbabilities():
-    def __init__(self, prob_same_state):
+    # Stay in the same key with probability prob_same_state, otherwise change to any other key
+    def __init__(self, prob_same_state, num_states=NUM_MODES * NUM_NOTES):
         self.prob_same_state = prob_same_state
-        self.prob_other_state = (1. - self.prob_same_state) / (NUM_MODES * NUM_NOTES - 1)
-        self.shape = (NUM_MODES * NUM_NOTES, NUM_MODES * NUM_NOTES)
+        self.prob_other_state = (1. - self.prob_same_state) / (num_states - 1)
+        self.shape = (num_states, num_states)
+        self.states = np.arange(num_states)
+        self.log_prob_same_state = math.log(self.prob_same_state)
+        self.log_prob_other_state = math.log(self.prob_other_state)
 
     def __getitem__(self, args):
         initial_state, final_state = args
@@ -186,7 +199,7 @@ class StateChangeProbabilities():
             return probability
 
         elif isinstance(initial_state, slice):
-            probabilities = np.array([self.prob_other_state] * NUM_MODES * NUM_NOTES)
+            probabilities = np.array([self.prob_other_state] * self.shape[0])
             probabilities[final_state] = self.prob_same_state
             #print(f">>> InitialState={initial_state} ; FinalState={final_state} -> Probabilities={probabilities}")
             return probabilities
@@ -194,11 +207,92 @@ class StateChangeProbabilities():
         else:
             raise TypeError("index must be int or slice")
 
+    def get_log_matrix(self):
+        # Dense (M x M) log transition matrix: initial state -> final state
+        log_matrix = np.full(self.shape, math.log(self.prob_other_state))
+        np.fill_diagonal(log_matrix, math.log(self.prob_same_state))
+        return log_matrix
+
+    def max_previous(self, omega):
+        # Same as max(i, ωi + log aij) and argmax for every j, without the (M x M) matrix: the best
+        # previous state is either j itself or the best of the other states
+        other = omega + self.log_prob_other_state
+        best_state = np.argmax(other)
+        if self.prob_same_state > self.prob_other_state:
+            # The best state always stays, so the best other state of any other state is the best state
+            # (ties are won by the lowest state, like np.argmax)
+            best = other[best_state]
+            same = omega + self.log_prob_same_state
+            stay = same > best
+            stay[:best_state] = same[:best_state] >= best
+            return np.maximum(same, best), np.where(stay, self.states, best_state)
+        else:
+            # The best other state of the best state is the second best
+            prev = np.full(self.shape[0], best_state)
+            prev[best_state] = np.argmax(np.where(self.states == best_state, -np.inf, other))
+            return _max_with_lowest_state(omega + self.log_prob_same_state, self.states, other[prev], prev)
+
+class RelatedKeyChangeProbabilities():
+    # Stay in the same key with probability prob_same_state, change to a closely related key (a fifth up
+    # or down in the same mode, or the relative key in another mode) with probability prob_related_state
+    # each, otherwise change to any other key.
+    # States are mode * 12 + root note, with the modes given by the offsets of their tonics.
+    def __init__(self, prob_same_state, prob_related_state, mode_tonics=MUSIC_MODE_TONICS):
+        num_modes = len(mode_tonics)
+        num_states = num_modes * NUM_NOTES
+        # Sorted, so that argmax finds the lowest of equally probable states, like a dense argmax does
+        self.related_states = np.sort([
+            [mode * NUM_NOTES + (note + 7) % 12, mode * NUM_NOTES + (note - 7) % 12] +
+            [other_mode * NUM_NOTES + (note - mode_tonics[mode] + mode_tonics[other_mode]) % 12 for other_mode in range(num_modes) if other_mode != mode]
+            for mode in range(num_modes) for note in range(NUM_NOTES)
+        ], axis=1)
+
+        num_related_states = self.related_states.shape[1]
+        self.prob_same_state = prob_same_state
+        self.prob_related_state = prob_related_state
+        self.prob_other_state = (1. - prob_same_state - num_related_states * prob_related_state) / (num_states - 1 - num_related_states)
+        if self.prob_other_state <= 0. or self.prob_other_state > min(prob_same_state, prob_related_state):
+            raise ValueError("unrelated keys must be less probable than related keys")
+        self.shape = (num_states, num_states)
+        self.states = np.arange(num_states)
+        self.log_prob_same_state = math.log(self.prob_same_state)
+        self.log_prob_related_state = math.log(self.prob_related_state)
+        self.log_prob_other_state = math.log(self.prob_other_state)
+
+    def __getitem__(self, args):
+        return np.exp(self.get_log_matrix()[args])
+
+    def get_log_matrix(self):
+        log_matrix = np.full(self.shape, math.log(self.prob_other_state))
+        log_matrix[self.related_states.ravel(), np.repeat(np.arange(self.shape[0]), self.related_states.shape[1])] = math.log(self.prob_related_state)
+        np.fill_diagonal(log_matrix, math.log(self.prob_same_state))
+        return log_matrix
+
+    def max_previous(self, omega):
+        # O(M x number of related keys): any other key is at most as probable as a related key, so it's
+        # enough to compare staying, the best related key and the best key overall
+        related = omega[self.related_states] + self.log_prob_related_state
+        best_related = np.argmax(related, axis=1)
+        prev = self.related_states[self.states, best_related]
+        values, prev = _max_with_lowest_state(omega + self.log_prob_same_state, self.states, related[self.states, best_related], prev)
+
+        other = omega + self.log_prob_other_state
+        best_state = np.argmax(other)
+        return _max_with_lowest_state(values, prev, other[best_state], best_state)
+
+def _max_with_lowest_state(values_1, states_1, values_2, states_2):
+    # Element-wise best of two candidates, the lowest state winning ties (like np.argmax)
+    second = (values_2 > values_1) | ((values_2 == values_1) & (states_2 < states_1))
+    return np.where(second, values_2, values_1), np.where(second, states_2, states_1)
+
 class EmissionProbabilities():
-    def __init__(self):
+    # Log emission tables already loaded, by cache key
+    LOG_TABLES = {}
+
+    def __init__(self, frequencies_major=MUSIC_KEY_FREQUENCIES_MAJOR, frequencies_minor=MUSIC_KEY_FREQUENCIES_MINOR):
         self.data = [
-            MUSIC_KEY_FREQUENCIES_MAJOR + MUSIC_KEY_FREQUENCIES_MAJOR,
-            MUSIC_KEY_FREQUENCIES_MINOR + MUSIC_KEY_FREQUENCIES_MINOR,
+            list(frequencies_major) * 2,
+            list(frequencies_minor) * 2,
         ]
 
     def get_probabilities(self, root_note, mode):
@@ -207,6 +301,26 @@ class EmissionProbabilities():
     def get_probabilities_for_histogram(self, root_note, mode, pitch_classes):
         return [p if (pitch_classes & 1<<(r%12) != 0) else (1. - p) for r, p in enumerate(self.data[mode][12 - root_note:24 - root_note])]
 
+    def get_log_table(self):
+        # Dense (M x 4096) log emission table: key state -> log probability of every 12-bit pitch class set
+        # Built once per set of key profiles and cached on disk (memory-mapped)
+        key = cache.get_key(self.data)
+        log_table = self.LOG_TABLES.get(key)
+        if log_table is None:
+            log_table = cache.load_array('key_log_emissions', key, self._build_log_table)
+            self.LOG_TABLES[key] = log_table
+        return log_table
+
+    def _build_log_table(self):
+        return self.get_log_emissions(np.arange(2**12)).T
+
+    def get_log_emissions(self, pitch_classes):
+        # (T) 12-bit pitch class sets -> (T x M) log emission probabilities, without the table
+        # State h = mode * 12 + note expects pitch class r with the frequency of degree (r - note) % 12
+        frequencies = np.array([[self.data[mode][12 - note + r] for r in range(12)] for mode in range(NUM_MODES) for note in range(NUM_NOTES)])
+        observations = (np.asarray(pitch_classes, dtype=np.int64)[:, None] >> np.arange(12)) & 1
+        return observations @ np.log(frequencies).T + (1 - observations) @ np.log(1. - frequencies).T
+
     def __getitem__(self, args):
         h, o = args
 
@@ -231,72 +345,245 @@ class EmissionProbabilities():
             #print(f">>> Note={note} ; Mode={mode} ; ObservableState={o:03x} ~ {o:012b} ; Data={p1}; {p2} -> {probability}")
             return probability
         elif isinstance(h, slice):
-            max_h = NUM_MODES * NUM_NOTES
-            v = np.array([0.5] * NUM_MODES * NUM_NOTES)
-            for i in range(*h.indices(max_h)):
-                note = i % 12
-                mode = i // 12
-                probabilities = self.get_probabilities(note, mode)
-                p1 = [round(p, 2) if c else math.nan for c, p in zip(pitch_classes, probabilities)]
-                p2 = [round(p, 2) if not c else math.nan for c, p in zip(pitch_classes, probabilities)]
-                #print(f">>> Note={note} ; Mode={mode} ; ObservableState={o:03x} ; Data={p1}; {p2}")
+            v = np.exp(self.get_log_table()[h, o])
             #print(f">>> Value={v}")
             return v
         else:
             raise TypeError("index must be int or slice")
 
-def viterbi(V, a, b, initial_distribution):
-    T = V.shape[0]
-    M = a.shape[0]
-
-    omega = np.zeros((T, M))
-    omega[0, :] = np.log(initial_distribution * b[:, V[0]])
-
-    prev = np.zeros((T - 1, M))
-
-    # ωi(t+1) = max(i, ωi(t)·aij·bjkv(t+1))
-
+class CountEmissionProbabilities():
+    # Multinomial emissions for pitch class count histograms: every note played is drawn from the pitch
+    # class distribution of the key, which is its key profile normalised (Krumhansl-style). Unlike
+    # EmissionProbabilities, notes played often weigh more than notes played once.
+    def __init__(self, profile_major=MUSIC_KEY_FREQUENCIES_MAJOR, profile_minor=MUSIC_KEY_FREQUENCIES_MINOR):
+        profiles = np.array([profile_major, profile_minor])
+        self.profiles = profiles / np.sum(profiles, axis=1, keepdims=True)
+
+    def get_log_profiles(self):
+        # (M x 12) log probability of every pitch class in every key state (mode * 12 + note)
+        return np.log(np.array([np.roll(self.profiles[mode], note) for mode in range(NUM_MODES) for note in range(NUM_NOTES)]))
+
+    def get_log_emissions(self, pitch_histograms):
+        # (T x 12) pitch class counts -> (T x M) log emission probabilities, in one matrix product
+        return np.asarray(pitch_histograms, dtype=np.float64).reshape(-1, 12) @ self.get_log_profiles().T
+
+def viterbi_log(log_b, log_a, log_initial_distribution):
+    # log_b: (T x M) log emission probabilities of each observation, log_a: (M x M) log transition matrix
+    T, M = log_b.shape
+    if T == 0:
+        return np.zeros(0, dtype=np.intp)
+
+    # ωj(t+1) = max(i, ωi(t) + log aij) + log bj(v(t+1))
     # One implementation trick is to use the log scale so that we dont get the underflow error.
+    omega = log_initial_distribution + log_b[0]
 
-    for t in range(1, T):
-        for j in range(M):
-            # Same as Forward Probability
-            probability = omega[t - 1] + np.log(a[:, j]) + np.log(b[j, V[t]])
+    # Most probable previous state of every state at every time step
+    prev = np.empty((T - 1, M), dtype=np.intp)
 
-            # This is our most probable state given previous state at time t (1)
-            prev[t - 1, j] = np.argmax(probability)
+    for t in range(1, T):
+        probability = omega[:, None] + log_a
+        prev[t - 1] = np.argmax(probability, axis=0)
+        omega = probability[prev[t - 1], np.arange(M)] + log_b[t]
 
-            # This is the probability of the most probable state (2)
-            omega[t, j] = np.max(probability)
+    # Backtrack from the most probable last hidden state
+    S = np.empty(T, dtype=np.intp)
+    S[-1] = np.argmax(omega)
+    for t in range(T - 2, -1, -1):
+        S[t] = prev[t, S[t + 1]]
 
-    # Path Array
-    S = np.zeros(T)
+    return S
 
-    # Find the most probable last hidden state
-    last_state = np.argmax(omega[T - 1, :])
+def viterbi_structured(log_b, a, log_initial_distribution):
+    # Same as viterbi_log, for transition probabilities that can find the best previous states
+    # without a dense matrix (see StateChangeProbabilities.max_previous): O(T·M) instead of O(T·M²)
+    T, M = log_b.shape
+    if T == 0:
+        return np.zeros(0, dtype=np.intp)
 
-    S[0] = last_state
+    omega = log_initial_distribution + log_b[0]
+    prev = np.empty((T - 1, M), dtype=np.intp)
 
-    backtrack_index = 1
-    for i in range(T - 2, -1, -1):
-        S[backtrack_index] = prev[i, int(last_state)]
-        last_state = prev[i, int(last_state)]
-        backtrack_index += 1
+    for t in range(1, T):
+        omega, prev[t - 1] = a.max_previous(omega)
+        omega += log_b[t]
 
-    # Flip the path array since we were backtracking
-    S = np.flip(S, axis=0)
+    S = np.empty(T, dtype=np.intp)
+    S[-1] = np.argmax(omega)
+    for t in range(T - 2, -1, -1):
+        S[t] = prev[t, S[t + 1]]
 
     return S
 
-
-def find_music_key(pitch_histograms):
+def viterbi(V, a, b, initial_distribution):
+    V = np.asarray(V, dtype=np.intp) & 0xFFF
+    with np.errstate(divide='ignore'):
+        log_initial_distribution = np.log(initial_distribution)
+    log_b = b.get_log_table()[:, V].T
+    if hasattr(a, 'max_previous'):
+        return viterbi_structured(log_b, a, log_initial_distribution)
+    return viterbi_log(log_b, a.get_log_matrix(), log_initial_distribution)
+
+def forward_backward_log(log_b, log_a, initial_distribution):
+    # Posterior probability of every state at every time step, P(state at t | all observations), as a
+    # (T x M) array. Scaled forward-backward: alpha and beta are normalised at every time step, and the
+    # emissions are scaled by their maximum at every time step, which cancels out in the posteriors.
+    T, M = log_b.shape
+    if T == 0:
+        return np.zeros((0, M))
+
+    alpha, beta, scale, a, b = _forward_backward_scaled(log_b, log_a, initial_distribution)
+    posteriors = alpha * beta
+    return posteriors / np.sum(posteriors, axis=1, keepdims=True)
+
+def baum_welch_statistics(log_b, log_a, initial_distribution):
+    # Expected statistics of one sequence for Baum-Welch training: the (T x M) posteriors, the (M x M)
+    # expected number of transitions between every pair of states, and the log likelihood of the sequence
+    T, M = log_b.shape
+    if T == 0:
+        return np.zeros((0, M)), np.zeros((M, M)), 0.
+
+    alpha, beta, scale, a, b = _forward_backward_scaled(log_b, log_a, initial_distribution)
+    posteriors = alpha * beta
+    posteriors /= np.sum(posteriors, axis=1, keepdims=True)
+
+    # ξt(i, j) = αt(i)·aij·bj(t+1)·βt+1(j) / ct+1, summed over t
+    transitions = (alpha[:-1].T @ (b[1:] * beta[1:] / scale[1:, None])) * a
+
+    log_likelihood = np.sum(np.log(scale)) + np.sum(np.max(log_b, axis=1))
+    return posteriors, transitions, log_likelihood
+
+def _forward_backward_scaled(log_b, log_a, initial_distribution):
+    T, M = log_b.shape
+    a = np.exp(log_a)
+    b = np.exp(log_b - np.max(log_b, axis=1, keepdims=True))
+
+    alpha = np.empty((T, M))
+    scale = np.empty(T)
+    alpha[0] = initial_distribution * b[0]
+    for t in range(T):
+        if t > 0:
+            alpha[t] = (alpha[t - 1] @ a) * b[t]
+        scale[t] = np.sum(alpha[t])
+        alpha[t] /= scale[t]
+
+    beta = np.empty((T, M))
+    beta[T - 1] = 1.
+    for t in range(T - 2, -1, -1):
+        beta[t] = a @ (b[t + 1] * beta[t + 1]) / scale[t + 1]
+
+    return alpha, beta, scale, a, b
+
+def forward_backward(V, a, b, initial_distribution):
+    V = np.asarray(V, dtype=np.intp) & 0xFFF
+    return forward_backward_log(b.get_log_table()[:, V].T, a.get_log_matrix(), initial_distribution)
+
+# Key finding parameters, as saved by key_finding_train.py: the emission model they are for ('masks' for
+# EmissionProbabilities, 'counts' for CountEmissionProbabilities), prob_same_state, and the profiles of
+# both modes (the frequencies of every degree of the scale, from the tonic)
+KEY_MODEL_MASKS = 'masks'
+KEY_MODEL_COUNTS = 'counts'
+
+def load_key_finding_parameters(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def save_key_finding_parameters(filename, parameters):
+    with open(filename, 'w') as f:
+        json.dump(parameters, f, indent=4)
+
+def get_key_finding_model(parameters=None, model=KEY_MODEL_MASKS):
+    # Transition and emission probabilities, with the default parameters when none are given
+    prob_same_state = 0.8
+    profiles = ()
+    if parameters:
+        if parameters.get('model', model) != model:
+            raise ValueError(f"parameters are for the '{parameters['model']}' model, not '{model}'")
+        prob_same_state = parameters['prob_same_state']
+        profiles = (parameters['profile_major'], parameters['profile_minor'])
+
+    if model == KEY_MODEL_COUNTS:
+        return StateChangeProbabilities(prob_same_state), CountEmissionProbabilities(*profiles)
+    return StateChangeProbabilities(prob_same_state), EmissionProbabilities(*profiles)
+
+def find_music_key(pitch_histograms, parameters=None):
     V = np.array(pitch_histograms)
-    a = StateChangeProbabilities(0.8)
-    b = EmissionProbabilities()
+    a, b = get_key_finding_model(parameters)
     initial_distribution = np.array([1] * NUM_MODES * NUM_NOTES)
     initial_distribution = initial_distribution / np.sum(initial_distribution)
     return [int(s) for s in viterbi(V, a, b, initial_distribution)]
 
+def find_music_key_probabilities(pitch_histograms, parameters=None):
+    # Same model as find_music_key: (bars x 24) posterior probabilities of every music key
+    V = np.array(pitch_histograms)
+    a, b = get_key_finding_model(parameters)
+    initial_distribution = np.array([1] * NUM_MODES * NUM_NOTES)
+    initial_distribution = initial_distribution / np.sum(initial_distribution)
+    return forward_backward(V, a, b, initial_distribution)
+
+def find_music_key_from_counts(pitch_histograms, parameters=None):
+    # Same as find_music_key, for (bars x 12) pitch class count histograms (see CountEmissionProbabilities)
+    a, b = get_key_finding_model(parameters, KEY_MODEL_COUNTS)
+    log_b = b.get_log_emissions(pitch_histograms)
+    log_initial_distribution = np.log(np.array([1. / (NUM_MODES * NUM_NOTES)] * NUM_MODES * NUM_NOTES))
+    return [int(s) for s in viterbi_structured(log_b, a, log_initial_distribution)]
+
+def find_music_key_probabilities_from_counts(pitch_histograms, parameters=None):
+    a, b = get_key_finding_model(parameters, KEY_MODEL_COUNTS)
+    log_b = b.get_log_emissions(pitch_histograms)
+    initial_distribution = np.array([1. / (NUM_MODES * NUM_NOTES)] * NUM_MODES * NUM_NOTES)
+    return forward_backward_log(log_b, a.get_log_matrix(), initial_distribution)
+
+class OnlineKeyTracker():
+    # Streaming key detection: incremental Viterbi over an unbounded sequence of pitch class sets (one per
+    # beat or time window), with constant cost and memory per step. Only the last 'lag' steps of back
+    # pointers are kept, and the published key is the state 'lag' steps back along the best path found
+    # so far (fixed-lag decision): a larger lag gives more stable keys, but later.
+    # The confidence is the probability of that key at the last step, from the (normalised) forward pass.
+    def __init__(self, lag=2, a=None, b=None, initial_distribution=None):
+        self.a = a if a is not None else StateChangeProbabilities(0.8)
+        self.log_b = (b if b is not None else EmissionProbabilities()).get_log_table()
+        num_states = self.a.shape[0]
+        if initial_distribution is None:
+            initial_distribution = np.array([1. / num_states] * num_states)
+        with np.errstate(divide='ignore'):
+            self.log_initial_distribution = np.log(initial_distribution)
+
+        self.transitions = np.exp(self.a.get_log_matrix())
+
+        self.lag = lag
+        self.prev = np.zeros((max(lag, 1), num_states), dtype=np.intp)
+        self.reset()
+
+    def reset(self):
+        self.omega = None
+        self.alpha = None
+        self.num_steps = 0
+        self.key = None
+        self.confidence = 0.
+
+    def push(self, pitch_classes):
+        log_b = self.log_b[:, pitch_classes & 0xFFF]
+        if self.omega is None:
+            omega = self.log_initial_distribution + log_b
+            alpha = np.exp(omega - np.max(omega))
+        else:
+            omega, self.prev[self.num_steps % len(self.prev)] = self.a.max_previous(self.omega)
+            omega += log_b
+            alpha = (self.alpha @ self.transitions) * np.exp(log_b - np.max(log_b))
+        self.alpha = alpha / np.sum(alpha)
+
+        # Normalised so that it never underflows, whatever the number of steps
+        self.omega = omega - np.max(omega)
+
+        state = np.argmax(self.omega)
+        for t in range(self.num_steps, self.num_steps - min(self.lag, self.num_steps), -1):
+            state = self.prev[t % len(self.prev), state]
+        self.num_steps += 1
+
+        self.key = int(state)
+        self.confidence = float(self.alpha[state])
+        return self.key
+
 def get_music_key_name(s):
     return '{}:{}'.format(NOTE_NAMES[int(s)%12], MODE_NAMES[int(s)//12])
 
@@ -4,20 +4,74 @@
 import sys
 sys.path.append('..')
 
+import io
 import math
-import time
-import cairo
-import layout
+import hashlib
+import threading
 import mido
-import time
-import sys
+import numpy as np
 
 from .general_midi import MIDI_GM1_INSTRUMENT_NAMES, MIDI_PERCUSSION_NAMES
-from .hmm_key_finding import find_music_key, get_music_key_name, get_root_note_from_music_key, get_scale_from_music_key
+from . import trace
+from . import cache
+from .scheduler import Scheduler
+from .musical_info import MusicalInfo
+from .hmm_chord_finding import find_chords
+from .hmm_key_finding import KEY_MODEL_MASKS, find_music_key, find_music_key_probabilities, find_music_key_from_counts, find_music_key_probabilities_from_counts, get_music_key_name, get_root_note_from_music_key, get_scale_from_music_key
+
+# Types of the compiled events. Note offs are notes with a null velocity, like in note_on messages.
+EVENT_NOTE           = 1 # channel, note, velocity
+EVENT_PROGRAM_CHANGE = 2 # channel, program
+EVENT_TEMPO          = 3 # tempo (microseconds per beat)
+EVENT_TIME_SIGNATURE = 4 # numerator, denominator
+
+# The default tempo is 500000 microseconds per beat, which is 120 beats per minute (BPM)
+DEFAULT_TEMPO = 500000
+
+# When seeking, the channel programs and held notes are restored from the last checkpoint, taken every
+# CHECKPOINT_EVENTS events, and the events after it
+CHECKPOINT_EVENTS = 256
+
+# One row per event, sorted by time. 'seconds' and 'tick' are absolute, from the start of the song.
+EVENT_DTYPE = np.dtype([
+    ('seconds',     np.float64),
+    ('tick',        np.int64),
+    ('type',        np.uint8),
+    ('channel',     np.uint8),
+    ('note',        np.uint8),
+    ('velocity',    np.uint8),
+    ('program',     np.uint8),
+    ('tempo',       np.uint32),
+    ('numerator',   np.uint8),
+    ('denominator', np.uint8),
+])
+
+# Bump when the analysis done by load_file changes, so that old cached results are not used
+ANALYSIS_VERSION = 2
+
+# Arrays of the analysis saved in the cache, by attribute name. 'info' is [ticks per beat, file type].
+ANALYSIS_ARRAYS = [
+    'info', 'events', 'instruments',
+    'bar_ticks', 'pitch_classes_per_bar', 'pitch_counts_per_bar', 'music_key_per_bar', 'music_key_confidence_per_bar',
+    'beat_ticks', 'pitch_classes_per_beat', 'chord_type_per_beat', 'chord_note_per_beat', 'chord_track_type_per_beat', 'chord_track_note_per_beat',
+]
+
+def _apply_event(event, channel_programs, held_notes):
+    # Updates the channel programs and held notes ((channel, note) -> velocity) with an event
+    seconds, tick, event_type, channel, note, velocity, program = event[:7]
+    if event_type == EVENT_NOTE:
+        if velocity:
+            held_notes[(channel, note)] = velocity
+        else:
+            held_notes.pop((channel, note), None)
+    elif event_type == EVENT_PROGRAM_CHANGE:
+        channel_programs[channel] = program
 
 class MidiFileSoundPlayer():
-    def __init__(self, midi_out=None):
+    def __init__(self, midi_out=None, key_finding_parameters=None):
         self.midi_out = midi_out
+        # Trained key finding parameters (see key_finding_train.py), or None for the default ones
+        self.key_finding_parameters = key_finding_parameters
 
         #~ self.fs = fluidsynth.Synth()
         #~ self.fs.start(driver="alsa")
@@ -27,19 +81,67 @@ class MidiFileSoundPlayer():
             #~ self.fs.program_select(channel, self.sfid, 0, 0)
 
         self.midi_file = None
+        self.ticks_per_beat = None
+        self.file_type = None
+        # Song compiled by load_file, as an array of EVENT_DTYPE
+        self.events = None
         self.chords_per_beat = {}
         self.full_song = {}
         self.instruments = set()
+        # Pitch classes (12-bit sets) held at the end of every bar, and number of notes of every pitch class
+        # played in every bar
+        self.pitch_classes_per_bar = None
+        self.pitch_counts_per_bar = None
         self.music_key_per_bar = None
+        # Posterior probability of the music key of every bar
+        self.music_key_confidence_per_bar = None
+        self.bar_ticks = None
+        # Chord of every beat, as parallel arrays: tick of the beat, chord type (index in
+        # MusicalInfo.CHORD_NAMES, or -1) and chord root note (or -1)
+        self.beat_ticks = None
+        self.chord_type_per_beat = None
+        self.chord_note_per_beat = None
+        # Pitch classes (12-bit sets) of every beat, aligned with beat_ticks
+        self.pitch_classes_per_beat = None
+        # Smoothed chord track found by the chord HMM, aligned with beat_ticks
+        self.chord_track_type_per_beat = None
+        self.chord_track_note_per_beat = None
+        # Index of the current beat in beat_ticks and of the current bar in bar_ticks, while playing
+        self.current_beat_index = 0
+        self.current_bar_index = 0
+        # Time index of the events, built when first needed: tempo in force after every event, and
+        # checkpoints of the channel programs and held notes
+        self.tempo_per_event = None
+        self.checkpoints = None
+        # Seek requested while playing (in seconds), and loop region as (start, end) in seconds
+        self.lock = threading.Lock()
+        self.seek_seconds = None
+        self.loop = None
+        # Playback deadlines, and how late the events were played
+        self.scheduler = Scheduler()
         self.running = False
 
-    def load_file(self, filename):
-        self.midi_file = mido.MidiFile(filename)
-        print('Midi File: {}'.format(self.midi_file.filename))
+    def load_file(self, filename, verbose=True, use_cache=True):
+        self.tempo_per_event = None
+        self.checkpoints = None
+
+        # The analysis is cached by file contents, so a song seen before is not parsed again
+        with open(filename, 'rb') as f:
+            data = f.read()
+        cache_key = cache.get_key(hashlib.sha1(data).hexdigest(), ANALYSIS_VERSION, self.key_finding_parameters)
+        if use_cache and self._load_analysis(cache_key):
+            self.midi_file = None
+            if verbose: print('Midi File: {} (cached analysis)'.format(filename))
+            return
+
+        self.midi_file = mido.MidiFile(filename, file=io.BytesIO(data))
+        self.ticks_per_beat = self.midi_file.ticks_per_beat
+        self.file_type = self.midi_file.type
+        if verbose: print('Midi File: {}'.format(self.midi_file.filename))
         length = self.midi_file.length
-        print('Song length: {} minutes, {} seconds'.format(int(length / 60), int(length % 60)))
+        if verbose: print('Song length: {} minutes, {} seconds'.format(int(length / 60), int(length % 60)))
 
-        tempo = 500000
+        tempo = DEFAULT_TEMPO
         ticks_per_beat = self.midi_file.ticks_per_beat
         time_signature_numerator = 4
         time_signature_denominator = 4
@@ -63,48 +165,65 @@ class MidiFileSoundPlayer():
 
         pitch_histogram_per_bar = []
 
+        # Number of notes played in every bar, by pitch class
+        pitch_counts_in_bar = np.zeros(12, dtype=np.int32)
+        pitch_counts_per_bar = []
+
         self.full_song = {}
 
         channel_programs = [0] * 16
         pitch_histogram = [0] * 12
         self.instruments = set()
+        events = []
+        seconds = 0.0
         for message in mido.midifiles.tracks.merge_tracks(self.midi_file.tracks):
             total_ticks_in_beat = ticks_per_beat * 4 / time_signature_denominator
             total_ticks_in_measure = ticks_per_beat * time_signature_numerator * 4 / time_signature_denominator
             time_of_measure = mido.midifiles.units.tick2second(total_ticks_in_measure, self.midi_file.ticks_per_beat, tempo)
 
+            # Absolute time of the message, at the tempo in force before it
+            tick = count_ticks_in_total + message.time
+            if message.time > 0:
+                seconds += mido.midifiles.units.tick2second(message.time, ticks_per_beat, tempo)
+
             notes_on = []
             notes_off = []
+            played_velocity = None
 
             if isinstance(message, mido.Message):
                 if message.type == 'note_on':
                     if message.channel != 9: # Exclude percussion 
-                        pitch_histogram[message.note % 12] += 1
-                        pitch_classes_in_beat |= 1 << (message.note % 12)
                         notes_on.append((message.channel, message.note, channel_programs[message.channel]))
+                        played_velocity = message.velocity
+                    events.append((seconds, tick, EVENT_NOTE, message.channel, message.note, message.velocity, 0, 0, 0, 0))
                 elif message.type == 'note_off':
                     if message.channel != 9: # Exclude percussion 
                         pitch_histogram[message.note % 12] -= 1
                         notes_off.append((message.channel, message.note))
+                    events.append((seconds, tick, EVENT_NOTE, message.channel, message.note, 0, 0, 0, 0, 0))
                 elif message.type == 'program_change':
                     self.instruments.add(message.program)
                     channel_programs[message.channel] = message.program
-
-                count_ticks_in_total += message.time
-                count_ticks_in_measure += message.time
-                count_ticks_in_beat += message.time
+                    events.append((seconds, tick, EVENT_PROGRAM_CHANGE, message.channel, 0, 0, message.program, 0, 0, 0))
 
             elif isinstance(message, mido.MetaMessage):
                 if message.type == 'set_tempo':
                     tempo = message.tempo
+                    events.append((seconds, tick, EVENT_TEMPO, 0, 0, 0, 0, message.tempo, 0, 0))
                 elif message.type == 'time_signature':
                     time_signature_numerator = message.numerator
                     time_signature_denominator = message.denominator
                     clocks_per_click = message.clocks_per_click
                     num_ticks = 0
+                    events.append((seconds, tick, EVENT_TIME_SIGNATURE, 0, 0, 0, 0, 0, message.numerator, message.denominator))
                 elif message.type == 'key_signature':
                     #music_key = message.key
-                    print('Key signature changed to {}'.format(message.key))
+                    if verbose: print('Key signature changed to {}'.format(message.key))
+
+            # Meta messages take time too
+            count_ticks_in_total += message.time
+            count_ticks_in_measure += message.time
+            count_ticks_in_beat += message.time
 
             try:
                 current_tick_in_song = self.full_song[count_ticks_in_total]
@@ -119,38 +238,123 @@ class MidiFileSoundPlayer():
                 count_ticks_in_beat -= total_ticks_in_beat
                 self.chords_per_beat[current_beat_tick] = pitch_classes_in_beat
                 self.full_song[current_beat_tick][2] = pitch_classes_in_beat
-                print(f"beat@{count_ticks_in_total}: {num_beat}:{current_beat_tick} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
+                if verbose: print(f"beat@{count_ticks_in_total}: {num_beat}:{current_beat_tick} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
                 current_beat_tick = count_ticks_in_total
                 pitch_classes_in_beat = sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)])
 
             while count_ticks_in_measure >= total_ticks_in_measure:
                 h = sum([1 << (n % 12) if pitch_histogram[n] > 0 else 0 for n in range(12)])
                 pitch_histogram_per_bar.append(h)
+                pitch_counts_per_bar.append(pitch_counts_in_bar)
+                pitch_counts_in_bar = np.zeros(12, dtype=np.int32)
                 self.full_song[current_bar_tick][1] = h
-                print(f"Bar #{num_bar}: {pitch_histogram} ({time_of_measure:1f} s) -> {h:03x} ~ {h:012b}")
+                if verbose: print(f"Bar #{num_bar}: {pitch_histogram} ({time_of_measure:1f} s) -> {h:03x} ~ {h:012b}")
                 bar_ticks.append(current_bar_tick)
                 num_bar += 1
                 current_bar_tick = count_ticks_in_total
                 count_ticks_in_measure -= total_ticks_in_measure
 
-        print(f"end@{count_ticks_in_total}: {num_beat}:{current_beat_tick} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
+            # A note on is played at the end of its delta time, so it belongs to the beat and bar
+            # started by the bar lines and beats crossed above
+            if played_velocity is not None:
+                pitch_class = notes_on[0][1] % 12
+                pitch_histogram[pitch_class] += 1
+                if played_velocity:
+                    pitch_counts_in_bar[pitch_class] += 1
+                pitch_classes_in_beat |= 1 << pitch_class
+
+        if verbose: print(f"end@{count_ticks_in_total}: {num_beat}:{current_beat_tick} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
         self.chords_per_beat[current_beat_tick] = pitch_classes_in_beat
 
         if count_ticks_in_measure:
             bar_ticks.append(current_bar_tick)
 
-        self.music_key_per_bar = find_music_key(pitch_histogram_per_bar)
-        print(['{:03x}={}'.format(v, get_music_key_name(s)) for v, s in zip(pitch_histogram_per_bar, self.music_key_per_bar)])
+        self.events = np.array(events, dtype=EVENT_DTYPE)
+
+        self.pitch_classes_per_bar = np.array(pitch_histogram_per_bar, dtype=np.int16)
+        self.pitch_counts_per_bar = np.array(pitch_counts_per_bar, dtype=np.int32).reshape(-1, 12)
+
+        # Keys are found from the number of notes of every pitch class played in every bar, unless the
+        # parameters are for the pitch class sets
+        parameters = self.key_finding_parameters
+        if parameters and parameters.get('model') == KEY_MODEL_MASKS:
+            self.music_key_per_bar = find_music_key(self.pitch_classes_per_bar, parameters)
+            key_probabilities = find_music_key_probabilities(self.pitch_classes_per_bar, parameters)
+        else:
+            self.music_key_per_bar = find_music_key_from_counts(self.pitch_counts_per_bar, parameters)
+            key_probabilities = find_music_key_probabilities_from_counts(self.pitch_counts_per_bar, parameters)
+        self.music_key_confidence_per_bar = key_probabilities[np.arange(len(self.music_key_per_bar)), self.music_key_per_bar]
+        if verbose: print(['{:03x}={}'.format(v, get_music_key_name(s)) for v, s in zip(pitch_histogram_per_bar, self.music_key_per_bar)])
 
         for i, (v, s) in enumerate(zip(pitch_histogram_per_bar, self.music_key_per_bar)):
             self.full_song[bar_ticks[i]][0] = s
             self.full_song[bar_ticks[i]][1] = v
 
-        print(f"end: {pitch_histogram}")
-        print([MIDI_GM1_INSTRUMENT_NAMES[i + 1] for i in self.instruments])
+        self.bar_ticks = np.array(bar_ticks, dtype=np.int64)
+        self._label_chords()
+
+        if verbose: print(f"end: {pitch_histogram}")
+        if verbose: print([MIDI_GM1_INSTRUMENT_NAMES[i + 1] for i in self.instruments])
 
         #print(self.full_song)
 
+        if use_cache:
+            self._save_analysis(cache_key)
+
+    def _save_analysis(self, cache_key):
+        arrays = {name: np.asarray(getattr(self, name)) for name in ANALYSIS_ARRAYS if name not in ('info', 'instruments')}
+        arrays['info'] = np.array([self.ticks_per_beat, self.file_type], dtype=np.int64)
+        arrays['instruments'] = np.array(sorted(self.instruments), dtype=np.int64)
+        cache.save_arrays('analysis', cache_key, arrays)
+
+    def _load_analysis(self, cache_key):
+        # Returns False if the song is not in the cache. The arrays are memory-mapped read-only.
+        arrays = cache.load_arrays('analysis', cache_key, ANALYSIS_ARRAYS)
+        if arrays is None:
+            return False
+        for name in ANALYSIS_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.ticks_per_beat, self.file_type = (int(v) for v in arrays['info'])
+        self.instruments = set(arrays['instruments'].tolist())
+        self.chords_per_beat = dict(zip(self.beat_ticks.tolist(), self.pitch_classes_per_beat.tolist()))
+        # Only used by the keyboard handlers song score, which is not cached
+        self.full_song = {}
+        return True
+
+    def _label_chords(self):
+        # Every beat is labelled with the chord found for its pitch classes, using the root of the
+        # music key of its bar to choose between ambiguous chords
+        self.beat_ticks = np.fromiter(self.chords_per_beat.keys(), dtype=np.int64, count=len(self.chords_per_beat))
+        chords = np.fromiter(self.chords_per_beat.values(), dtype=np.int64, count=len(self.chords_per_beat))
+        order = np.argsort(self.beat_ticks, kind='stable')
+        self.beat_ticks = self.beat_ticks[order]
+        chords = chords[order]
+        self.pitch_classes_per_beat = chords
+
+        if len(self.music_key_per_bar) and len(self.bar_ticks):
+            bar_per_beat = np.searchsorted(self.bar_ticks, self.beat_ticks, side='right') - 1
+            bar_per_beat = np.clip(bar_per_beat, 0, len(self.music_key_per_bar) - 1)
+            root_notes = np.array(self.music_key_per_bar, dtype=np.int64)[bar_per_beat] % 12
+        else:
+            root_notes = np.zeros(len(chords), dtype=np.int64)
+
+        self.chord_type_per_beat, self.chord_note_per_beat = MusicalInfo.label_chords(chords, root_notes)
+        self.chord_track_type_per_beat, self.chord_track_note_per_beat = find_chords(chords)
+
+    def get_chord_name(self, num_beat, smoothed=False):
+        # Name of the chord of a beat (index in beat_ticks), e.g. 'G Dominant 7th Chord', or '' if none
+        if smoothed:
+            chord_type, chord_note = self.chord_track_type_per_beat[num_beat], self.chord_track_note_per_beat[num_beat]
+        else:
+            chord_type, chord_note = self.chord_type_per_beat[num_beat], self.chord_note_per_beat[num_beat]
+        if chord_type < 0:
+            return ''
+        return f"{MusicalInfo.NOTE_NAMES[chord_note]} {MusicalInfo.CHORD_NAMES[chord_type]}"
+
+    def get_current_chord(self):
+        # Chord type and root note of the chord track at the current beat, while playing
+        return self.chord_track_type_per_beat[self.current_beat_index], self.chord_track_note_per_beat[self.current_beat_index]
+
     def __del__(self):
         #~ self.fs.delete()
         #~ print("FluidSynth Closed")
@@ -159,9 +363,164 @@ class MidiFileSoundPlayer():
 
     def stop(self):
         self.running = False
+        self.scheduler.interrupt()
+
+    def get_tick_seconds(self, tick):
+        # Time of a tick from the start of the song, in seconds
+        self._build_time_index()
+        index = int(np.searchsorted(self.events['tick'], tick, side='right')) - 1
+        if index < 0:
+            return mido.midifiles.units.tick2second(tick, self.ticks_per_beat, DEFAULT_TEMPO)
+        return float(self.events['seconds'][index]) + mido.midifiles.units.tick2second(tick - int(self.events['tick'][index]), self.ticks_per_beat, int(self.tempo_per_event[index]))
+
+    def get_seconds_tick(self, seconds):
+        # Tick at a time from the start of the song (in seconds), the inverse of get_tick_seconds
+        self._build_time_index()
+        index = int(np.searchsorted(self.events['seconds'], seconds, side='right')) - 1
+        if index < 0:
+            return round(mido.midifiles.units.second2tick(seconds, self.ticks_per_beat, DEFAULT_TEMPO))
+        return int(self.events['tick'][index]) + round(mido.midifiles.units.second2tick(seconds - float(self.events['seconds'][index]), self.ticks_per_beat, int(self.tempo_per_event[index])))
+
+    def get_bar_seconds(self, bar):
+        # Time of the start of a bar (numbered from 1), or of the end of the song after the last bar
+        if bar > len(self.bar_ticks):
+            return float(self.events['seconds'][-1]) if len(self.events) else 0.0
+        return self.get_tick_seconds(int(self.bar_ticks[max(bar, 1) - 1]))
+
+    def seek(self, seconds=None, bar=None):
+        # Jumps to a time (in seconds) or to the start of a bar (numbered from 1), at once while playing
+        if (seconds is None) == (bar is None):
+            raise ValueError("Either seconds or bar must be given to seek")
+        if bar is not None:
+            seconds = self.get_bar_seconds(bar)
+        with self.lock:
+            self.seek_seconds = max(0.0, seconds)
+        self.scheduler.interrupt()
+
+    def set_loop(self, start=None, end=None, start_bar=None, end_bar=None):
+        # Plays again from 'start' every time 'end' is reached, in seconds or in bars (the end bar included).
+        # By default, from the start to the end of the song.
+        if start_bar is not None:
+            start = self.get_bar_seconds(start_bar)
+        if end_bar is not None:
+            end = self.get_bar_seconds(end_bar + 1)
+        if start is None:
+            start = 0.0
+        if end is None:
+            end = self.get_bar_seconds(len(self.bar_ticks) + 1)
+        if not start < end:
+            raise ValueError(f"Empty loop region: {start:.3f} - {end:.3f} s")
+        with self.lock:
+            self.loop = (start, end)
+        self.scheduler.interrupt()
+
+    def clear_loop(self):
+        with self.lock:
+            self.loop = None
+
+    def _build_time_index(self):
+        if self.checkpoints is not None:
+            return
+        types = self.events['type']
+        last_tempo_change = np.maximum.accumulate(np.where(types == EVENT_TEMPO, np.arange(len(types)), -1)) if len(types) else np.zeros(0, dtype=np.int64)
+        self.tempo_per_event = np.where(last_tempo_change >= 0, self.events['tempo'][np.maximum(last_tempo_change, 0)], DEFAULT_TEMPO)
+
+        # checkpoints[n] is the state before event n * CHECKPOINT_EVENTS
+        checkpoints = []
+        channel_programs = [0] * 16
+        held_notes = {}
+        events = self.events.tolist()
+        for index, event in enumerate(events):
+            if index % CHECKPOINT_EVENTS == 0:
+                checkpoints.append((list(channel_programs), dict(held_notes)))
+            _apply_event(event, channel_programs, held_notes)
+        if len(events) % CHECKPOINT_EVENTS == 0:
+            checkpoints.append((list(channel_programs), dict(held_notes)))
+        self.checkpoints = checkpoints
+
+    def _chase(self, seconds, events, channel_programs, held_notes):
+        # Restores the channel programs and held notes at a time (in seconds): notes being played are
+        # stopped, and notes held at that time (except percussion) are played again. Returns the index of
+        # the next event and the tempo in force.
+        self._build_time_index()
+        index = int(np.searchsorted(self.events['seconds'], seconds, side='left'))
+        checkpoint = index // CHECKPOINT_EVENTS
+        programs, held = self.checkpoints[checkpoint]
+        programs, held = list(programs), dict(held)
+        for event in events[checkpoint * CHECKPOINT_EVENTS:index]:
+            _apply_event(event, programs, held)
+
+        self._play_notes([(channel, note, 0) for channel, note in held_notes])
+        for channel in range(16):
+            if programs[channel] != channel_programs[channel]:
+                channel_programs[channel] = programs[channel]
+                if self.midi_out:
+                    self.midi_out.change_program(channel, programs[channel])
+        held_notes.clear()
+        held_notes.update({(channel, note): velocity for (channel, note), velocity in held.items() if channel != 9})
+        self._play_notes([(channel, note, velocity) for (channel, note), velocity in held_notes.items()])
+
+        tempo = int(self.tempo_per_event[index - 1]) if index else DEFAULT_TEMPO
+        return index, tempo
+
+    def _seek_position(self, tick):
+        # Beat and bar at a tick, after seeking
+        self.current_beat_index = max(0, int(np.searchsorted(self.beat_ticks, tick, side='right')) - 1)
+        self.current_bar_index = max(0, int(np.searchsorted(self.bar_ticks, tick, side='right')) - 1)
+        self._record_bar()
+        self._record_beat()
+
+    def _track_position(self, tick):
+        while self.current_bar_index + 1 < len(self.bar_ticks) and self.bar_ticks[self.current_bar_index + 1] <= tick:
+            self.current_bar_index += 1
+            self._record_bar()
+        while self.current_beat_index + 1 < len(self.beat_ticks) and self.beat_ticks[self.current_beat_index + 1] <= tick:
+            self.current_beat_index += 1
+            self._record_beat()
+
+    def _record_beat(self):
+        pitch_classes_in_beat = int(self.pitch_classes_per_beat[self.current_beat_index])
+        if trace.recorder:
+            chord_note = self.chord_track_note_per_beat[self.current_beat_index]
+            trace.recorder.record(trace.SOURCE_FILE_PLAYER, trace.EVENT_BEAT, note=trace.NO_NOTE if chord_note < 0 else chord_note, chord=pitch_classes_in_beat, value=self.current_beat_index + 1)
+
+        #~ for keyboard_handler in self.keyboard_handlers:
+            #~ keyboard_handler.set_chord(pitch_classes_in_beat)
+
+    def _record_bar(self):
+        if self.current_bar_index < len(self.music_key_per_bar):
+            music_key = int(self.music_key_per_bar[self.current_bar_index])
+        else:
+            music_key = None
+        if trace.recorder:
+            trace.recorder.record(trace.SOURCE_FILE_PLAYER, trace.EVENT_BAR, note=trace.NO_NOTE if music_key is None else music_key, value=self.current_bar_index + 1)
+
+        #~ if not music_key is None and self.keyboard_handlers:
+            #~ for keyboard_handler in self.keyboard_handlers:
+                #~ keyboard_handler.change_root(get_root_note_from_music_key(music_key), get_scale_from_music_key(music_key))
+
+    def set_rate(self, rate):
+        # Playback speed, relative to the tempo of the song (e.g. 0.5 for half speed). Can be changed
+        # while playing: the events left are rescheduled from the current position.
+        self.scheduler.set_rate(rate)
+
+    def get_rate(self):
+        return self.scheduler.get_rate()
+
+    def get_position(self):
+        # Current time in the song, in seconds, while playing
+        return self.scheduler.get_position()
+
+    def get_lateness_stats(self):
+        # Number of events played and p50/p99/max lateness (in seconds) of the last session
+        return self.scheduler.lateness.get_stats()
+
+    def _play_notes(self, events):
+        if self.midi_out and events:
+            self.midi_out.play_notes(events)
 
     def play(self):
-        if self.midi_file.type == 2: # Can't merge tracks in type 2 (asynchronous) file
+        if self.file_type == 2: # Can't merge tracks in type 2 (asynchronous) file
             return
 
         self.running = True
@@ -174,46 +533,17 @@ class MidiFileSoundPlayer():
 
         channel_programs = [0] * 16
 
-        start_time = time.time() + 1.
-        input_time = 0.0
+        self.scheduler.start(1.0)
 
         # The default tempo is 500000 microseconds per beat, which is 120 beats per minute (BPM)
         # You can use bpm2tempo() and tempo2bpm() to convert to and from beats per minute.
         # Note that tempo2bpm() may return a floating point number.
-        tempo = 500000
-
-        # Also called Pulses per Quarter note or PPQ. Typical values range from 96 to 480
-        # You can use tick2second() and second2tick() to convert to and from seconds and ticks.
-        # Note that integer rounding of the result might be necessary because MIDI files require ticks to be integers.
-        ticks_per_beat = self.midi_file.ticks_per_beat
-
-        # A Time Signature is two numbers, one on top of the other. The numerator describes the number of beats in a Bar,
-        # while the denominator describes of what note value a beat is (ie, how many quarter notes there are in a beat).
-        # If a time signature message is not present in a MIDI sequence, 4/4 signature is assumed.
-        # 4/4 would be four quarter-notes per bar (MIDI default)
-        # 4/2 would be four half-notes per bar (or 8 quarter notes)
-        # 4/8 would be four eighth-notes per bar (or 2 quarter notes)
-        # 2/4 would be two quarter-notes per bar
-        time_signature_numerator = 4
-        time_signature_denominator = 4
-
-        # Metronome pulse in terms of the number of MIDI clock ticks per click
-        # Assuming 24 MIDI clocks per quarter note, if the value of the sixth byte is 48, the metronome will click every
-        # two quarter notes, or in other words, every half-note
-        clocks_per_click = 24
-
-        # Number of 32nd notes per beat. This byte is usually 8 as there is usually one quarter note per beat
-        # and one quarter note contains eight 32nd notes.
-        # It seems to be useless and unused in practice: https://www.midi.org/forum/473-smf-time-signature-confusion
-        notated_32nd_notes_per_beat = 8
+        tempo = DEFAULT_TEMPO
 
-        count_ticks_in_total = 0
-        count_ticks_in_beat = 0
-        count_ticks_in_measure = 0
-        num_bar = 1
-        num_beat = 1
+        self.current_beat_index = 0
+        self.current_bar_index = 0
 
-        pitch_classes_in_beat = self.chords_per_beat[0]
+        pitch_classes_in_beat = self.pitch_classes_per_beat[0]
         music_key = self.music_key_per_bar[0]
         print(f"bar #1 (start) -> {get_music_key_name(music_key)}")
 
@@ -222,110 +552,83 @@ class MidiFileSoundPlayer():
                 #~ keyboard_handler.change_root(get_root_note_from_music_key(music_key), get_scale_from_music_key(music_key))
                 #~ keyboard_handler.set_chord(pitch_classes_in_beat)
 
-        print(f"beat@{count_ticks_in_total}: {num_beat} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
-
-        for message in mido.midifiles.tracks.merge_tracks(self.midi_file.tracks):
-            if not self.running:
-                break
-
-            total_ticks_in_beat = ticks_per_beat * 4 / time_signature_denominator
-            total_ticks_in_measure = ticks_per_beat * time_signature_numerator * 4 / time_signature_denominator
-
-            if message.time > 0:
-                time_delta = mido.midifiles.units.tick2second(message.time, self.midi_file.ticks_per_beat, tempo)
-            else:
-                time_delta = 0
-
-            input_time += time_delta
-            playback_time = time.time() - start_time
-            time_to_next_event = input_time - playback_time
-
-            # Find bar:beat:subbeat
-
-            if not isinstance(message, mido.MetaMessage):
-                count_ticks_in_total += message.time
-                count_ticks_in_measure += message.time
-                count_ticks_in_beat += message.time
-
-            while count_ticks_in_beat >= total_ticks_in_beat:
-                num_beat += 1
-                count_ticks_in_beat -= total_ticks_in_beat
-                pitch_classes_in_beat = self.chords_per_beat[count_ticks_in_total]
-                print(f"beat@{count_ticks_in_total}: {num_beat} -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
-
-                #~ for keyboard_handler in self.keyboard_handlers:
-                    #~ keyboard_handler.set_chord(pitch_classes_in_beat)
-
-            while count_ticks_in_measure >= total_ticks_in_measure:
-                try:
-                    music_key = self.music_key_per_bar[num_bar-1]
-                except IndexError:
-                    music_key = None
-                num_bar += 1
-                count_ticks_in_measure -= total_ticks_in_measure
-                if not music_key is None:
-                    print(f"bar #{num_bar} -> {get_music_key_name(music_key)}")
-
-                    #~ if self.keyboard_handlers:
-                        #~ for keyboard_handler in self.keyboard_handlers:
-                            #~ keyboard_handler.change_root(get_root_note_from_music_key(music_key), get_scale_from_music_key(music_key))
-
+        print(f"beat@0: 1 -> {pitch_classes_in_beat:#06x} = {pitch_classes_in_beat:>012b}")
+
+        # Notes that happen at the same time are sent together
+        simultaneous_notes = []
+        deadline_tick = -1
+        # Notes being played, as (channel, note) -> velocity, to stop them or play them again when seeking
+        held_notes = {}
+
+        events = self.events.tolist()
+        index = 0
+        while self.running and index < len(events):
+            with self.lock:
+                seek_seconds, self.seek_seconds = self.seek_seconds, None
+                loop = self.loop
+
+            if seek_seconds is None and loop and events[index][0] >= loop[1]:
+                # Back to the start of the loop when its end is reached (at once if it was already passed)
+                self._play_notes(simultaneous_notes)
+                simultaneous_notes = []
+                if index and events[index - 1][0] < loop[1] and self.scheduler.wait(loop[1]) is None:
+                    continue
+                seek_seconds = loop[0]
+
+            if seek_seconds is not None:
+                self._play_notes(simultaneous_notes)
+                simultaneous_notes = []
+                index, tempo = self._chase(seek_seconds, events, channel_programs, held_notes)
+                self.scheduler.set_position(seek_seconds)
+                self._seek_position(self.get_seconds_tick(seek_seconds))
+                deadline_tick = -1
+                continue
+
+            seconds, tick, event_type, channel, note, velocity, program, event_tempo, numerator, denominator = events[index]
+
+            # Waited once for all the events at the same tick
+            if tick != deadline_tick:
+                self._play_notes(simultaneous_notes)
+                simultaneous_notes = []
+                if self.scheduler.wait(seconds) is None:
+                    continue # Interrupted by seek(), set_loop(), set_rate() or stop()
+                deadline_tick = tick
+
+            self._track_position(tick)
+
+            if event_type == EVENT_NOTE:
+                simultaneous_notes.append((channel, note, velocity))
+                if velocity:
+                    held_notes[(channel, note)] = velocity
                 else:
-                    print(f"bar #{num_bar}")
+                    held_notes.pop((channel, note), None)
 
-            if time_to_next_event > 0.0:
-                time.sleep(time_to_next_event)
+                #~ if self.keyboard_handlers:
+                    #~ for keyboard_handler in self.keyboard_handlers:
+                        #~ keyboard_handler.press(note, channel, velocity > 0, channel == 9)
 
-            current_timestamp = time.time_ns() / (10 ** 9) # Converted to floating-point seconds
-            #sys.stdout.write(repr(message) + '\n')
-            #sys.stdout.flush()
-            if isinstance(message, mido.Message):
-                if message.type == 'note_on':
-                    if self.midi_out:
-                        self.midi_out.play_note(message.channel, message.note, message.velocity)
-
-                    #~ if self.keyboard_handlers:
-                        #~ for keyboard_handler in self.keyboard_handlers:
-                            #~ #self.last_notes.append((current_timestamp, message.note, message.channel, True))
-                            #~ keyboard_handler.press(message.note, message.channel, True, message.channel == 9)
-
-                elif message.type == 'note_off':
-                    if self.midi_out:
-                        self.midi_out.play_note(message.channel, message.note, 0)
-
-                    #~ if self.keyboard_handlers:
-                        #~ for keyboard_handler in self.keyboard_handlers:
-                            #~ #self.last_notes.append((current_timestamp, message.note, message.channel, False))
-                            #~ keyboard_handler.press(message.note, message.channel, False, message.channel == 9)
+            elif event_type == EVENT_PROGRAM_CHANGE:
+                self._play_notes(simultaneous_notes)
+                simultaneous_notes = []
+                channel_programs[channel] = program
+                #~ print('Program for {} changed to {} ("{}")'.format(channel, program, MIDI_GM1_INSTRUMENT_NAMES[program + 1]))
+                if self.midi_out:
+                    self.midi_out.change_program(channel, program)
 
-                elif message.type == 'control_change':
-                    #print('Control {} for {} changed to {}'.format(message.control, message.channel, message.value))
-                    pass
+            elif event_type == EVENT_TEMPO:
+                tempo = event_tempo
+                print('Tempo changed to {:.1f} BPM.'.format(mido.tempo2bpm(tempo)))
 
-                elif message.type == 'program_change':
-                    channel_programs[message.channel] = message.program
-                    #~ self.fs.program_select(message.channel, self.sfid, 0, message.program)
-                    #~ print('Program for {} changed to {} ("{}")'.format(message.channel, message.program, MIDI_GM1_INSTRUMENT_NAMES[message.program + 1]))
-                    if self.midi_out:
-                        self.midi_out.change_program(message.channel, message.program)
-
-            elif isinstance(message, mido.MetaMessage):
-                if message.type == 'set_tempo':
-                    tempo = message.tempo
-                    print('Tempo changed to {:.1f} BPM.'.format(mido.tempo2bpm(message.tempo)))
-                elif message.type == 'time_signature':
-                    time_signature_numerator = message.numerator
-                    time_signature_denominator = message.denominator
-                    clocks_per_click = message.clocks_per_click
-                    notated_32nd_notes_per_beat = message.notated_32nd_notes_per_beat
-                    num_ticks = 0
-                    print(f'Time signature changed to {message.numerator}/{message.denominator}. Clocks per click: {message.clocks_per_click}, Notated 32nd Notes per_Beat: {message.notated_32nd_notes_per_beat}')
-                elif message.type == 'key_signature':
-                    print(f'Key signature changed to {message.key}')
+            elif event_type == EVENT_TIME_SIGNATURE:
+                print(f'Time signature changed to {numerator}/{denominator}.')
 
             #~ if self.keyboard_handlers:
                 #~ for keyboard_handler in self.keyboard_handlers:
-                    #~ keyboard_handler.set_tick(count_ticks_in_total, tempo * 1e-6 / ticks_per_beat)
+                    #~ keyboard_handler.set_tick(tick, tempo * 1e-6 / ticks_per_beat)
+
+            index += 1
+
+        self._play_notes(simultaneous_notes)
 
         #~ if self.keyboard_handlers:
             #~ for keyboard_handler in self.keyboard_handlers:
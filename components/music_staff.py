@@ -92,6 +92,7 @@ class MusicStaffElement(layout.root.LayoutElement):
 
     def render(self, rect, ctx):
         xpos, ypos, width, height = rect.get_data()
+        keys_pressed = self.music_info.state.keys_pressed
 
         cx = xpos + width / 2.
         cy = ypos + height / 2.
@@ -126,13 +127,13 @@ class MusicStaffElement(layout.root.LayoutElement):
 
         max_note = self.SCORE_MAX_NOTE
         for note in range(self.MAX_NOTE, max_note, -1):
-            if self.music_info.keys_pressed[note]:
+            if keys_pressed[note]:
                 max_note = note
                 break
 
         min_note = self.SCORE_MIN_NOTE
         for note in range(self.MIN_NOTE, min_note - 1, 1):
-            if self.music_info.keys_pressed[note]:
+            if keys_pressed[note]:
                 min_note = note
                 break
 
@@ -149,14 +150,14 @@ class MusicStaffElement(layout.root.LayoutElement):
 
                 if (note > self.SCORE_MAX_NOTE and note <= max_note) or \
                    (note < self.SCORE_MIN_NOTE and note >= min_note) or \
-                   (note == self.SCORE_MID_NOTE and self.music_info.keys_pressed[note]):
+                   (note == self.SCORE_MID_NOTE and keys_pressed[note]):
                         ctx.set_source_rgb(0.0, 0.1, 0.3)
                         ctx.set_line_width(1)
                         ctx.move_to(x - 6, y)
                         ctx.line_to(x + 6, y)
                         ctx.stroke()
 
-            if self.music_info.keys_pressed[note]:
+            if keys_pressed[note]:
                 ctx.set_source_rgb(0.0, 0.0, 0.0)
                 ctx.arc(x, y, 4, 0, 2. * math.pi)
                 ctx.fill()
@@ -5,9 +5,15 @@ import sys
 sys.path.append('..')
 
 import time
-from threading import Thread, Lock
+from array import array
+from collections import namedtuple
+from threading import Thread, Lock, Condition
 
-from .colors import lab_to_rgb, rgb_to_lab
+import numpy as np
+
+from .colors import lab_to_rgb, lab_to_rgb_array, rgb_to_lab
+from . import trace
+from .hmm_key_finding import OnlineKeyTracker
 
 class MusicDefs:
     INTVL_UNISON            = 1<<0  # Root Note / Tonic
@@ -45,6 +51,8 @@ class MusicDefs:
     TRIAD_INVERSION_FIRST  = 1
     # Second inversion: the fifth of the chord is the bass note
     TRIAD_INVERSION_SECOND = 2
+    # Slash chord: the bass note is not a note of the chord
+    CHORD_INVERSION_SLASH  = -1
 
     # When creating a chord you generally¹ stack thirds on top of each other and
     # name the chord after the number of steps from the root note to the highest added note.
@@ -227,26 +235,55 @@ def get_lower_bit_pos(value):
         value >>= 1
     return 0
 
-class FifoList():
-    def __init__(self):
-        self.data = {}
+class NoteRingBuffer():
+    # Fixed-capacity single-producer/single-consumer queue of (timestamp, pitch class) pairs.
+    # Only the producer moves nextin and only the consumer moves nextout, so no lock is needed
+    # as long as there is a single thread (or a serialized group of threads) on each side.
+    def __init__(self, capacity=1024):
+        self.capacity = 1 << (capacity - 1).bit_length() # Rounded up to a power of two
+        self.mask = self.capacity - 1
+        self.timestamps = array('d', [0.]) * self.capacity
+        self.pitch_classes = array('B', [0]) * self.capacity
         self.nextin = 0
         self.nextout = 0
-        self.lock = Lock()
-    def append(self, data):
-        with self.lock:
-            self.nextin += 1
-            self.data[self.nextin] = data
-    def pop(self):
-        with self.lock:
-            self.nextout += 1
-            result = self.data[self.nextout]
-            del self.data[self.nextout]
-        return result
+        self.overflows = 0 # Number of entries rejected because the buffer was full
+        self.max_size = 0 # High-water mark
+    def __len__(self):
+        return self.nextin - self.nextout
+    def append(self, timestamp, pitch_class):
+        size = self.nextin - self.nextout
+        if size >= self.capacity:
+            self.overflows += 1
+            return False
+        pos = self.nextin & self.mask
+        self.timestamps[pos] = timestamp
+        self.pitch_classes[pos] = pitch_class
+        self.nextin += 1
+        if size >= self.max_size:
+            self.max_size = size + 1
+        return True
     def peek(self):
-        with self.lock:
-            result = self.data[self.nextout + 1] if self.data else None
-        return result
+        if self.nextout == self.nextin:
+            return None
+        return self.timestamps[self.nextout & self.mask]
+    def drain_until(self, timestamp):
+        # Pops every entry with a timestamp up to the given one, returning their pitch classes
+        nextout = self.nextout
+        nextin = self.nextin
+        pitch_classes = []
+        while nextout != nextin and self.timestamps[nextout & self.mask] <= timestamp:
+            pitch_classes.append(self.pitch_classes[nextout & self.mask])
+            nextout += 1
+        self.nextout = nextout
+        return pitch_classes
+
+# Immutable view of the state of MusicalInfo, replaced as a whole on every change so that
+# renderers can read it without locking. The version increases with every new snapshot.
+MusicalState = namedtuple('MusicalState', [
+    'version', 'root_note', 'scale', 'notes_in_scale', 'note_names', 'keys_pressed',
+    'pitch_classes', 'chord', 'chord_note', 'fuzzy_pitch_classes', 'fuzzy_chord', 'chord_color',
+    'channel_chords', 'bass_note', 'inversion', 'chord_name', 'key_confidence',
+])
 
 class MusicalInfo():
     #NOTE_NAMES = ['I', 'ii', 'II', 'iii', 'III', 'IV', 'v', 'V', 'vi', 'VI', 'vii', 'VII']
@@ -300,8 +337,45 @@ class MusicalInfo():
                         chord_mask |= 1 << (i + num_note) % 12
                     chord_info[0][i] = chord_mask
 
+    # Rotation tables, one per chord name: interval between the root and the bass note -> inversion
+    # (the position of the bass note in the chord intervals, or CHORD_INVERSION_SLASH)
+    CHORD_INVERSIONS = {}
+    for chords_list in CHORDS_INFO:
+        for chord_info in chords_list:
+            CHORD_INVERSIONS[chord_info[2]] = [MusicDefs.CHORD_INVERSION_SLASH] * 12
+            for inversion, num_note in reversed(list(enumerate(chord_info[1]))):
+                CHORD_INVERSIONS[chord_info[2]][num_note % 12] = inversion
+
+    # Flat list of chord names, used to store chord types as small integers in NumPy arrays
+    CHORD_NAMES = [chord_info[2] for chords_list in CHORDS_INFO for chord_info in chords_list]
+
+    # Lazily built lookup tables, one per root note: pitch class set (12 bits) -> chord info
+    CHORD_INDEX = [None] * 12
+
+    # Lookup tables of chord colors, one per luminance: pitch class set (12 bits) -> RGB
+    CHORD_COLOR_TABLES = {}
+
+    # Chord index tables as NumPy arrays, one per root note: pitch class set (12 bits) -> chord note (or -1)
+    CHORD_NOTE_ARRAYS = [None] * 12
+
+    # Chord index tables for all root notes at once, as (12 x 4096) NumPy arrays of chord types
+    # (index in CHORD_NAMES, or -1) and chord notes (or -1). Built lazily by get_chord_label_tables
+    CHORD_TYPE_TABLE = None
+    CHORD_NOTE_TABLE = None
+
+    NUM_CHANNELS = 16
+
+    # A key change moves the root note, and so the notes of the pads and their colours, so live key
+    # tracking only follows the keys that are probable enough
+    MIN_KEY_CONFIDENCE = 0.6
+
     def __init__(self):
-        self.set_root(60, MusicDefs.SCALE_DIATONIC_MAJOR)
+        self.lock = Lock()
+        # Signalled whenever a released note is queued or the memory threshold changes
+        self.notes_released = Condition(self.lock)
+        self.running = False
+        self.thread = None
+
         self.note_names = self.NOTE_NAMES
 
         max_octaves = 10
@@ -309,210 +383,422 @@ class MusicalInfo():
 
         self.pitch_classes = [0] * 12
         self.chord = 0
-        self.chord_color = None
         self.chord_note = -1
         self.num_notes_in_chord = 0
         self.symmetry = True
 
-        self.last_notes = FifoList()
+        self.last_notes = NoteRingBuffer()
         self.mem_threshold = 0.0 # In floating-point seconds
         self.fuzzy_pitch_classes = [0] * 12
         self.fuzzy_chord = 0
 
-        self.lock = Lock()
+        # Per channel pitch class histograms (one row per MIDI channel) and pitch class sets
+        self.channel_pitch_classes = np.zeros((self.NUM_CHANNELS, 12), dtype=np.int32)
+        self.channel_chords = (0,) * self.NUM_CHANNELS
+        self.channel_analysis = None
+
+        # Every key being pressed, as a bitset (bit n = MIDI note n), and the voicing of the chord
+        self.keys_mask = 0
+        self.found_chord = (0, -1, '', [])
+        self.bass_note = -1
+        self.inversion = MusicDefs.TRIAD_INVERSION_NONE
+        self.chord_name = ''
+
+        # Live key detection (disabled unless start_key_tracking is called): pitch classes played in
+        # every time window are fed to an online HMM key tracker, which moves the root note
+        self.key_tracker = None
+        self.key_window = 0.0 # In floating-point seconds
+        self.key_window_deadline = None
+        self.window_chord = 0
+        self.music_key = None
+        # Probability of the root note and scale being the right ones (1.0 when set by hand)
+        self.key_confidence = 1.0
+
+        self.state = None
+        self.set_root(60, MusicDefs.SCALE_DIATONIC_MAJOR)
 
     def __del__(self):
         self.stop()
 
     def _run(self):
         print("~ Running Musical Info Thread")
-        while self.running:
-            current_timestamp = time.time_ns() / (10 ** 9) # Converted to floating-point seconds
-            threshold_timestamp = current_timestamp - self.mem_threshold
-
-            try:
-                queue_timestamp = self.last_notes.peek()[0]
-            except (TypeError, IndexError):
-                queue_timestamp = None
-
-            fuzzy_chord = self.fuzzy_chord
-            while not queue_timestamp is None and queue_timestamp < threshold_timestamp:
-                timestamp, pitch_class = self.last_notes.pop()
-
-                print(f"[Delayed Note: ({timestamp}, {pitch_class}))")
+        with self.notes_released:
+            while self.running:
+                queue_timestamp = self.last_notes.peek()
+
+                # Sleep until the oldest released note has to be forgotten, or until the key tracking window
+                # ends, or until playNote wakes us up
+                deadline = None if queue_timestamp is None else queue_timestamp + self.mem_threshold
+                if self.key_tracker and (deadline is None or self.key_window_deadline < deadline):
+                    deadline = self.key_window_deadline
+                if deadline is None:
+                    self.notes_released.wait()
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self.notes_released.wait(deadline - now)
+                    continue
+
+                if self.key_tracker and self.key_window_deadline <= now:
+                    self._track_key(now)
+
+                if queue_timestamp is not None and queue_timestamp + self.mem_threshold <= now:
+                    pitch_classes = self.last_notes.drain_until(now - self.mem_threshold)
+                    self._forget_pitch_classes(pitch_classes)
 
-                with self.lock:
-                    self.fuzzy_pitch_classes[pitch_class] -= 1
-                    if not self.fuzzy_pitch_classes[pitch_class]:
-                        self.fuzzy_chord &= ~(1<<(pitch_class))
-
-                try:
-                    queue_timestamp = self.last_notes.peek()[0]
-                except (TypeError, IndexError):
-                    queue_timestamp = None
-
-            if fuzzy_chord != self.fuzzy_chord:
-                print(f"Fuzzy pitch class histogram: {self.fuzzy_chord:#06x} = {self.fuzzy_chord:>012b}")
-                with self.lock:
-                    self.chord_color = None
-
-            time.sleep(0.001 * 5)
         print("~ Stopping Musical Info Thread")
 
+    def _forget_pitch_classes(self, pitch_classes):
+        # Must be called with self.lock held
+        fuzzy_chord = self.fuzzy_chord
+        for pitch_class in pitch_classes:
+            self.fuzzy_pitch_classes[pitch_class] -= 1
+            if not self.fuzzy_pitch_classes[pitch_class]:
+                self.fuzzy_chord &= ~(1<<(pitch_class))
+
+        if fuzzy_chord != self.fuzzy_chord:
+            if trace.recorder: trace.recorder.record(trace.SOURCE_MUSIC_INFO, trace.EVENT_FUZZY_CHORD, chord=self.fuzzy_chord)
+            self._publish_state()
+
+    def _track_key(self, now):
+        # Must be called with self.lock held. Pitch classes played during the window, and the ones still held
+        window_chord = self.window_chord | self.chord
+        self.window_chord = 0
+        self.key_window_deadline += self.key_window
+        if self.key_window_deadline <= now:
+            self.key_window_deadline = now + self.key_window
+
+        # Silence says nothing about the key
+        if not window_chord:
+            return
+
+        music_key = self.key_tracker.push(window_chord)
+        if music_key != self.music_key and self.key_tracker.confidence < self.MIN_KEY_CONFIDENCE:
+            return
+        if music_key != self.music_key or self.key_tracker.confidence != self.key_confidence:
+            self.music_key = music_key
+            scale = [MusicDefs.SCALE_DIATONIC_MAJOR, MusicDefs.SCALE_NATURAL_MINOR][music_key // 12]
+            self._set_root(60 + music_key % 12, scale, self.key_tracker.confidence)
+
+    def start_key_tracking(self, window=2.0, lag=2):
+        with self.lock:
+            self.key_tracker = OnlineKeyTracker(lag)
+            self.key_window = window
+            self.key_window_deadline = time.monotonic() + window
+            self.window_chord = 0
+            self.music_key = None
+            self.notes_released.notify()
+
+    def stop_key_tracking(self):
+        with self.lock:
+            self.key_tracker = None
+
+    def _publish_state(self):
+        # Must be called with self.lock held
+        version = self.state.version + 1 if self.state else 1
+        self.state = MusicalState(
+            version, self.root_note, self.scale, tuple(self.notes_in_scale), tuple(self.note_names),
+            tuple(self.keys_pressed), tuple(self.pitch_classes), self.chord, self.chord_note,
+            tuple(self.fuzzy_pitch_classes), self.fuzzy_chord, self.get_chord_color_table()[self.fuzzy_chord & 0xFFF],
+            self.channel_chords, self.bass_note, self.inversion, self.chord_name, self.key_confidence,
+        )
+
+    @property
+    def version(self):
+        return self.state.version
+
     def start(self):
         self.running = True
         self.thread = Thread(target = self._run, args = ())
         self.thread.start()
 
     def stop(self):
-        self.running = False
+        with self.notes_released:
+            self.running = False
+            self.notes_released.notify()
         if self.thread:
             self.thread.join()
         self.thread = None
 
-    def set_root(self, note, scale=MusicDefs.SCALE_DIATONIC_MAJOR):
+    def set_root(self, note, scale=MusicDefs.SCALE_DIATONIC_MAJOR, key_confidence=1.0):
+        with self.lock:
+            self._set_root(note, scale, key_confidence)
+
+    def _set_root(self, note, scale, key_confidence=1.0):
+        # Must be called with self.lock held
         self.scale = scale
         self.root_note = note
+        self.key_confidence = key_confidence
         self.notes_in_scale = [(self.scale & 1<<((r - self.root_note) % 12) != 0) for r in range(12)]
+        self._publish_state()
 
     def playNote(self, channel, note, velocity):
-        pitch_class = note % 12
-        chord = self.chord
-        fuzzy_chord = self.fuzzy_chord
-        if velocity:
-            with self.lock:
-                self.keys_pressed[note] |= (1<<channel)
-                self.pitch_classes[pitch_class] += 1
-                if self.pitch_classes[pitch_class]:
-                    chord |= 1<<(pitch_class)
+        self.play_notes([(channel, note, velocity)])
 
-                self.fuzzy_pitch_classes[pitch_class] += 1
-                if self.fuzzy_pitch_classes[pitch_class]:
-                    self.fuzzy_chord |= 1<<(pitch_class)
+    def play_notes(self, events):
+        # Applies a batch of (channel, note, velocity) events at once and analyses the resulting chord only once
+        with self.lock:
+            chord = self.chord
+            fuzzy_chord = self.fuzzy_chord
+            channel_pitch_classes = self.channel_pitch_classes
+            channel_chords = list(self.channel_chords)
+            keys_mask = self.keys_mask
+            window_chord = self.window_chord
+            for channel, note, velocity in events:
+                pitch_class = note % 12
+                if velocity:
+                    self.keys_pressed[note] |= (1<<channel)
+                    keys_mask |= 1<<note
+                    window_chord |= 1<<(pitch_class)
+                    channel_pitch_classes[channel, pitch_class] += 1
+                    if channel_pitch_classes[channel, pitch_class] > 0:
+                        channel_chords[channel] |= 1<<(pitch_class)
+                    else:
+                        channel_chords[channel] &= ~(1<<(pitch_class))
+                    self.pitch_classes[pitch_class] += 1
+                    if self.pitch_classes[pitch_class]:
+                        chord |= 1<<(pitch_class)
+
+                    self.fuzzy_pitch_classes[pitch_class] += 1
+                    if self.fuzzy_pitch_classes[pitch_class]:
+                        self.fuzzy_chord |= 1<<(pitch_class)
+
+                else:
+                    self.keys_pressed[note] &= ~(1<<channel)
+                    if not self.keys_pressed[note]:
+                        keys_mask &= ~(1<<note)
+                    channel_pitch_classes[channel, pitch_class] -= 1
+                    if channel_pitch_classes[channel, pitch_class] > 0:
+                        channel_chords[channel] |= 1<<(pitch_class)
+                    else:
+                        channel_chords[channel] &= ~(1<<(pitch_class))
+                    self.pitch_classes[pitch_class] -= 1
+                    if not self.pitch_classes[pitch_class]:
+                        chord &= ~(1<<(pitch_class))
+
+                    # Queued under the lock so that the queue stays sorted by release time
+                    if self.last_notes.append(time.monotonic(), pitch_class):
+                        self.notes_released.notify()
+                    else:
+                        # No room left to remember the note: forget it right away
+                        self._forget_pitch_classes([pitch_class])
 
-                    if fuzzy_chord != self.fuzzy_chord:
-                        print(f"Fuzzy pitch class histogram: {self.fuzzy_chord:#06x} = {self.fuzzy_chord:>012b}")
-                        self.chord_color = None
+            if fuzzy_chord != self.fuzzy_chord:
+                if trace.recorder: trace.recorder.record(trace.SOURCE_MUSIC_INFO, trace.EVENT_FUZZY_CHORD, chord=self.fuzzy_chord)
 
-        else:
-            with self.lock:
-                self.keys_pressed[note] &= ~(1<<channel)
-                self.pitch_classes[pitch_class] -= 1
-                if not self.pitch_classes[pitch_class]:
-                    chord &= ~(1<<(pitch_class))
-
-            current_timestamp = time.time_ns() / (10 ** 9) # Converted to floating-point seconds
-            self.last_notes.append((current_timestamp, pitch_class))
-
-        if chord != self.chord:
-            print(f"Pitch class histogram: {chord:#06x} = {chord:>012b}")
-            with self.lock:
-                self.chord_color = None
+            if chord != self.chord:
                 self.chord = chord
                 self.num_notes_in_chord = count_bits(chord)
 
-            if self.num_notes_in_chord >= 3 and self.mem_threshold > 0:
-                with self.lock:
+                if self.num_notes_in_chord >= 3 and self.mem_threshold > 0:
                     self.mem_threshold = 0.0
-            elif self.num_notes_in_chord < 3 and self.num_notes_in_chord > 0 and not self.mem_threshold > 0:
-                with self.lock:
+                    self.notes_released.notify()
+                elif self.num_notes_in_chord < 3 and self.num_notes_in_chord > 0 and not self.mem_threshold > 0:
                     self.mem_threshold = 0.5
+                    self.notes_released.notify()
 
-            chord_signature, chord_note, chord_name, chord_intervals = self._find_chord()
-
-            chord = chord + chord * 2**12
-            self.major_thirds = chord >> 4 & chord & 0b111111111111
-            self.minor_thirds = chord >> 3 & chord & 0b111111111111
-            self.thirds = self.minor_thirds | self.major_thirds
-            self.fifths = chord >> 7 & chord & 0b111111111111
+                self._analyse_chord()
+                self._analyse_voicing(keys_mask)
 
-            self.symmetry = ((chord >> 2) & 0b111111111111 == self.chord) or ((chord >> 3) & 0b111111111111 == self.chord) or \
-                            ((chord >> 4) & 0b111111111111 == self.chord) or ((chord >> 6) & 0b111111111111 == self.chord)
+            elif (keys_mask & -keys_mask).bit_length() - 1 != self.bass_note:
+                # Same pitch classes but the lowest key changed
+                self._analyse_voicing(keys_mask)
 
+            self.keys_mask = keys_mask
+            self.window_chord = window_chord
+            self.channel_chords = tuple(channel_chords)
+            self._publish_state()
 
-            pattern = 0
-            self.chord_note = chord_note
-            if chord and not self.symmetry:
-                if self.chord_note == -1:
-                    #~ all_fifths = ((chord >> 6 & chord) | (chord >> 7 & chord) | (chord >> 8 & chord)) & 0b111111111111
-                    #~ all_thirds = ((chord >> 3 & chord) | (chord >> 4 & chord)) & 0b111111111111
+    def _analyse_chord(self):
+        # Must be called with self.lock held
+        self.found_chord = self._find_chord()
+        chord_signature, chord_note, chord_name, chord_intervals = self.found_chord
 
-                    #~ if self.fifths:
-                        #~ pattern = self.fifths
-                    #~ elif all_thirds:
-                        #~ pattern = all_thirds
-                    #~ elif all_fifths:
-                        #~ pattern = all_fifths
+        chord = self.chord + self.chord * 2**12
+        self.major_thirds = chord >> 4 & chord & 0b111111111111
+        self.minor_thirds = chord >> 3 & chord & 0b111111111111
+        self.thirds = self.minor_thirds | self.major_thirds
+        self.fifths = chord >> 7 & chord & 0b111111111111
 
-                    if pattern:
-                        values = [((pattern | (pattern << 12)) >> v) & 0xFFF for v in range(12)]
-                        self.chord_note = min(range(len(values)), key=values.__getitem__)
+        self.symmetry = ((chord >> 2) & 0b111111111111 == self.chord) or ((chord >> 3) & 0b111111111111 == self.chord) or \
+                        ((chord >> 4) & 0b111111111111 == self.chord) or ((chord >> 6) & 0b111111111111 == self.chord)
 
-            else:
-                self.chord_note = -1
 
-            print(f"Chord: {chord & 0xFFF:03x} ~ {chord & 0xFFF:012b} -> Note: {self.chord_note}, " +
-                  f"Major 3rds: {self.major_thirds:03x} ~ {self.major_thirds:012b}, " +
-                  f"Minor 3rds: {self.minor_thirds:03x} ~ {self.minor_thirds:012b}, " +
-                  f"All 3rds: {self.thirds:03x} ~ {self.thirds:012b}, 5ths: {self.fifths:03x} ~ {self.fifths:012b}, " +
-                  f"Pattern: {pattern:03x} ~ {pattern:012b}");
-
-    def getChordColor(self):
-        if self.chord_color is None:
-            pitch_classes = self.fuzzy_pitch_classes
-            chord = self.fuzzy_chord
-            chord_intervals = []
-            if chord:
-                for i in range(12):
-                    pitch_class = (i - self.root_note) % 12
-                    if pitch_classes[pitch_class]:
-                        chord_intervals.append(pitch_class)
-            self.chord_color = self._get_chord_color(chord, chord_intervals)
-        return self.chord_color
-
-    def _get_chord_color(self, chord, chord_intervals, luminance=75.):
-        if not chord or not chord_intervals:
-            return lab_to_rgb(luminance, 0., 0.)
-
-        chord = chord & 0b111111111111
-        chord = chord + chord * 2**12
-        major_thirds = chord >> 4 & chord & 0b111111111111
-        minor_thirds = chord >> 3 & chord & 0b111111111111
-        thirds = minor_thirds | major_thirds
+        pattern = 0
+        self.chord_note = chord_note
+        if chord and not self.symmetry:
+            if self.chord_note == -1:
+                #~ all_fifths = ((chord >> 6 & chord) | (chord >> 7 & chord) | (chord >> 8 & chord)) & 0b111111111111
+                #~ all_thirds = ((chord >> 3 & chord) | (chord >> 4 & chord)) & 0b111111111111
 
-        if not thirds:
-            return lab_to_rgb(luminance, 0., 0.)
+                #~ if self.fifths:
+                    #~ pattern = self.fifths
+                #~ elif all_thirds:
+                    #~ pattern = all_thirds
+                #~ elif all_fifths:
+                    #~ pattern = all_fifths
 
-        values = [((thirds | (thirds << 12)) >> v) & 0xFFF for v in range(12)]
-        chord_note = min(range(len(values)), key=values.__getitem__)
+                if pattern:
+                    values = [((pattern | (pattern << 12)) >> v) & 0xFFF for v in range(12)]
+                    self.chord_note = min(range(len(values)), key=values.__getitem__)
 
-        axis_lr = (sum(chord_intervals) / len(chord_intervals) - 11./3) / 13.5
-
-        vdif = [(((c * 7) % 12) - c / 7.) * 7. / 24. for c in chord_intervals]
-        axis_ud = sum(vdif) / len(vdif) * 3. / 5.
-
-        vmaj = (major_thirds | (major_thirds << 12)) >> chord_note
-        nmaj = [(1. / (n + 1) if (((vmaj | (vmaj << 12)) >> n) & 1) else 0.) for n in range(12)]
-
-        vmin = (minor_thirds | (minor_thirds << 12)) >> chord_note
-        nmin = [(1. / (n + 1) if (((vmin | (vmin << 12)) >> n) & 1) else 0.) for n in range(12)]
+        else:
+            self.chord_note = -1
 
-        axis_mm = 5. * (sum(nmaj) - sum(nmin) ) / len(chord_intervals)
+        if trace.recorder:
+            trace.recorder.record(trace.SOURCE_MUSIC_INFO, trace.EVENT_CHORD, note=self.chord_note if self.chord_note >= 0 else trace.NO_NOTE,
+                                  chord=self.chord, value=chord_signature)
 
-        chord_color = lab_to_rgb(luminance, (3 * axis_mm + axis_ud) * -20., axis_lr * 80.)
-        #print(f"Chord Color: intervals = {chord_intervals}, nmaj = {nmaj}, nmin = {nmin}, " +
-        #      f"axis_mm = {axis_mm:.2f}, axis_ud = {axis_ud:.2f}, axis_lr = {axis_lr:.2f} -> {chord_color}")
+    def getChordColor(self):
+        return self.state.chord_color
+
+    @classmethod
+    def get_chord_color_table(cls, luminance=75.):
+        chord_color_table = cls.CHORD_COLOR_TABLES.get(luminance)
+        if chord_color_table is None:
+            chord_color_table = cls._build_chord_color_table(luminance)
+            cls.CHORD_COLOR_TABLES[luminance] = chord_color_table
+        return chord_color_table
+
+    @staticmethod
+    def _build_chord_color_table(luminance=75.):
+        # Colors for the 4096 possible pitch class sets, computed all at once. The color only depends on
+        # which pitch classes are present, so the table does not depend on the root note.
+        notes = np.arange(12)
+        chords = np.arange(4096)
+        in_chord = (chords[:, np.newaxis] >> notes) & 1
+        num_notes = np.maximum(in_chord.sum(axis=1), 1)
+
+        chords = chords + chords * 2**12
+        major_thirds = chords >> 4 & chords & 0b111111111111
+        minor_thirds = chords >> 3 & chords & 0b111111111111
+        thirds = minor_thirds | major_thirds
 
-        return chord_color
+        # Rotation that makes the thirds pattern smallest (the first one, in case of a tie)
+        rotations = ((thirds | (thirds << 12))[:, np.newaxis] >> notes) & 0xFFF
+        chord_notes = np.argmin(rotations, axis=1)
+
+        axis_lr = ((in_chord @ notes) / num_notes - 11./3) / 13.5
+
+        vdif = (((notes * 7) % 12) - notes / 7.) * 7. / 24.
+        axis_ud = (in_chord @ vdif) / num_notes * 3. / 5.
+
+        weights = 1. / (notes + 1)
+        vmaj = ((major_thirds | (major_thirds << 12)) >> chord_notes)[:, np.newaxis] >> notes & 1
+        vmin = ((minor_thirds | (minor_thirds << 12)) >> chord_notes)[:, np.newaxis] >> notes & 1
+        axis_mm = 5. * (vmaj @ weights - vmin @ weights) / num_notes
+
+        colors = lab_to_rgb_array(luminance, (3 * axis_mm + axis_ud) * -20., axis_lr * 80.)
+        colors[thirds == 0] = lab_to_rgb(luminance, 0., 0.)
+
+        return colors.tolist()
+
+    def _analyse_voicing(self, keys_mask):
+        # Must be called with self.lock held. Uses the lowest key being pressed as the bass note.
+        # The chord note of symmetric chords (augmented, diminished 7th...) is ambiguous, so they are not named
+        chord_signature, chord_note, chord_name, chord_intervals = self.found_chord
+        chord_note = self.chord_note
+        self.bass_note = (keys_mask & -keys_mask).bit_length() - 1
+        if chord_note < 0 or self.bass_note < 0:
+            self.inversion = MusicDefs.TRIAD_INVERSION_NONE
+            self.chord_name = ''
+            return
+
+        bass_pitch_class = self.bass_note % 12
+        self.inversion = self.CHORD_INVERSIONS[chord_name][(bass_pitch_class - chord_note) % 12]
+        self.chord_name = f"{self.note_names[chord_note]} {chord_name}"
+        if self.inversion != MusicDefs.TRIAD_INVERSION_NONE:
+            self.chord_name += f" / {self.note_names[bass_pitch_class]}"
+
+    def get_channel_analysis(self, state=None):
+        # Chord notes, major thirds, minor thirds and fifths of every channel, as NumPy arrays. This is
+        # computed on demand (e.g. once per frame) for all the channels at once, and never per note.
+        state = state or self.state
+        key = (state.root_note % 12, state.channel_chords)
+        channel_analysis = self.channel_analysis
+        if channel_analysis is None or channel_analysis[0] != key:
+            channel_analysis = (key, self.analyse_chords(np.array(state.channel_chords, dtype=np.int32), state.root_note))
+            self.channel_analysis = channel_analysis
+        return channel_analysis[1]
+
+    @classmethod
+    def analyse_chords(cls, chords, root_note):
+        # Same analysis as _analyse_chord, for an array of pitch class sets
+        chord_notes = cls.get_chord_note_array(root_note)[chords]
+
+        chords = chords + chords * 2**12
+        major_thirds = chords >> 4 & chords & 0b111111111111
+        minor_thirds = chords >> 3 & chords & 0b111111111111
+        fifths = chords >> 7 & chords & 0b111111111111
+
+        # The chord note of symmetric chords is ambiguous, as in _analyse_chord
+        single_chords = chords & 0b111111111111
+        symmetry = (((chords >> 2) & 0b111111111111) == single_chords) | (((chords >> 3) & 0b111111111111) == single_chords) | \
+                   (((chords >> 4) & 0b111111111111) == single_chords) | (((chords >> 6) & 0b111111111111) == single_chords)
+        chord_notes = np.where(symmetry, -1, chord_notes)
+
+        return chord_notes, major_thirds, minor_thirds, fifths
 
     def _find_chord(self):
-        pitch_classes = self.chord
-        for chords_list in self.CHORDS_INFO:
+        pitch_classes = self.chord & 0xFFF
+        return self.get_chord_index(self.root_note)[pitch_classes]
+
+    @classmethod
+    def get_chord_index(cls, root_note):
+        root_note = root_note % 12
+        chord_index = cls.CHORD_INDEX[root_note]
+        if chord_index is None:
+            chord_index = cls._build_chord_index(root_note)
+            cls.CHORD_INDEX[root_note] = chord_index
+        return chord_index
+
+    @classmethod
+    def get_chord_note_array(cls, root_note):
+        root_note = root_note % 12
+        chord_notes = cls.CHORD_NOTE_ARRAYS[root_note]
+        if chord_notes is None:
+            chord_notes = np.array([chord_info[1] for chord_info in cls.get_chord_index(root_note)], dtype=np.int32)
+            cls.CHORD_NOTE_ARRAYS[root_note] = chord_notes
+        return chord_notes
+
+    @classmethod
+    def get_chord_label_tables(cls):
+        if cls.CHORD_TYPE_TABLE is None:
+            chord_types = {chord_name: n for n, chord_name in enumerate(cls.CHORD_NAMES)}
+            chord_types[''] = -1
+            cls.CHORD_TYPE_TABLE = np.array([[chord_types[chord_info[2]] for chord_info in cls.get_chord_index(root_note)] for root_note in range(12)], dtype=np.int16)
+            cls.CHORD_NOTE_TABLE = np.array([cls.get_chord_note_array(root_note) for root_note in range(12)], dtype=np.int8)
+        return cls.CHORD_TYPE_TABLE, cls.CHORD_NOTE_TABLE
+
+    @classmethod
+    def label_chords(cls, chords, root_notes):
+        # Labels an array of pitch class sets in one pass, each one using the chord priorities of its
+        # own root note (typically the root of the music key of its bar).
+        # Returns the chord types (index in CHORD_NAMES, or -1) and the chord notes (or -1)
+        chord_type_table, chord_note_table = cls.get_chord_label_tables()
+        chords = np.asarray(chords, dtype=np.int64) & 0xFFF
+        root_notes = np.asarray(root_notes, dtype=np.int64) % 12
+        return chord_type_table[root_notes, chords], chord_note_table[root_notes, chords]
+
+    @classmethod
+    def _build_chord_index(cls, root_note):
+        # Chords are visited in the same priority order used when scanning CHORDS_INFO: by chord group,
+        # then by root along the circle of fifths starting at root_note, then by template. Every pitch
+        # class set that contains a chord signature gets the first chord that claims it.
+        chord_index = [None] * 4096
+        for chords_list in cls.CHORDS_INFO:
             for n in range(12):
+                note = (root_note + n * 7) % 12
                 for chord_signatures, chord_intervals, chord_name in chords_list:
-                    note = (self.root_note + n * 7) % 12
                     chord_signature = chord_signatures[note]
-                    if (pitch_classes & chord_signature) == chord_signature:
-                        print(f"Found: {chord_name} on {self.note_names[note % 12]} ({pitch_classes:012b} - {chord_signature:012b})")
-                        return (chord_signature, note % 12, chord_name, chord_intervals)
-        return (0, -1, '', [])
+                    chord_info = (chord_signature, note, chord_name, chord_intervals)
+                    free_notes = ~chord_signature & 0xFFF
+                    extra_notes = free_notes
+                    while True:
+                        if chord_index[chord_signature | extra_notes] is None:
+                            chord_index[chord_signature | extra_notes] = chord_info
+                        if not extra_notes:
+                            break
+                        extra_notes = (extra_notes - 1) & free_notes
+        no_chord = (0, -1, '', [])
+        return [no_chord if chord_info is None else chord_info for chord_info in chord_index]
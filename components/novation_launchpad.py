@@ -11,6 +11,7 @@ import random
 import cairo
 import layout
 from . import launchpad
+from . import trace
 
 from threading import Thread, Lock
 
@@ -70,6 +71,8 @@ class LaunchpadManager:
         self.lpbox = lpbox
         self.midi_out = midi_out
         self.notes_cache = {}
+        # Note played by every pressed button, so that it's released even if the root changed since
+        self.pressed_notes = {}
 
     def __del__(self): # See:https://eli.thegreenplace.net/2009/06/12/safely-using-destructors-in-python/
         print("~ Closing LaunchpadManager")
@@ -166,15 +169,15 @@ class LaunchpadManager:
         self.lp.Reset()
 
     def init_colors(self, lpbox):
-        music_info = lpbox.music_info
-        self.scale = music_info.scale
-        self.root_note = music_info.root_note
+        state = lpbox.music_info.state
+        self.scale = state.scale
+        self.root_note = state.root_note
 
         lp_layout = lpbox.lp_layout
 
-        notes_in_scale = music_info.notes_in_scale
-        root_note = music_info.root_note % 12
-        note_names = music_info.note_names
+        notes_in_scale = state.notes_in_scale
+        root_note = state.root_note % 12
+        note_names = state.note_names
 
         for y in range(1, 9):
             for x in range(1, 9):
@@ -200,16 +203,18 @@ class LaunchpadManager:
                 lpbox.setCodeColor(button_num, color_code, False)
 
     def init_notes_cache(self, root_note, lp_layout):
-        self.notes_cache = {}
+        # Built apart and then swapped, as play_note reads it from other threads
+        notes_cache = {}
         for y in range(1, 9):
             for x in range(1, 9):
                 note = root_note + lp_layout(x - 1, y - 1)
                 button_num = x + y * 10
-                old_button_num = self.notes_cache.get(note)
+                old_button_num = notes_cache.get(note)
                 if not old_button_num is None:
                     if abs(old_button_num % 10 - 5) + abs(old_button_num // 10 - 5) < abs(button_num % 10 - 5) + abs(button_num // 10 - 5):
                         button_num = old_button_num
-                self.notes_cache[note] = button_num
+                notes_cache[note] = button_num
+        self.notes_cache = notes_cache
 
     def _run(self, lpbox, midi_out):
         print("~ Running LaunchpadManager Thread")
@@ -230,11 +235,13 @@ class LaunchpadManager:
         while self.running:
             but = self.lp.ButtonStateRaw()
 
-            if self.root_note != lpbox.music_info.root_note or  self.scale != lpbox.music_info.scale:
+            state = lpbox.music_info.state
+            if self.root_note != state.root_note or self.scale != state.scale:
                 self.init_colors(lpbox)
+                self.init_notes_cache(state.root_note, lpbox.lp_layout)
 
             if but != []:
-                print( "Button Event: ", but )
+                if trace.recorder: trace.recorder.record(trace.SOURCE_LAUNCHPAD, trace.EVENT_BUTTON, velocity=but[1], value=but[0])
                 #self.lp.LedCtrlRaw( random.randint(0,127), random.randint(0,63), random.randint(0,63), random.randint(0,63) )
                 #~ c = random.randint(0, 128)
                 c = 3
@@ -243,9 +250,15 @@ class LaunchpadManager:
                     button_y = but[0] // 10
                     if button_x <= 8 and button_y <= 8:
                         channel = 1
-                        note = lpbox.music_info.root_note + lpbox.lp_layout(button_x - 1, button_y - 1)
+                        if but[1]:
+                            note = state.root_note + lpbox.lp_layout(button_x - 1, button_y - 1)
+                            self.pressed_notes[but[0]] = note
+                        else:
+                            note = self.pressed_notes.pop(but[0], None)
+                            if note is None: # Pressed before the manager started
+                                note = state.root_note + lpbox.lp_layout(button_x - 1, button_y - 1)
                         velocity = 127 if but[1] else 0
-                        print(f"Launchpad Note: [{button_x}, {button_y}] -> {note} ({lpbox.music_info.note_names[note%12]})")
+                        if trace.recorder: trace.recorder.record(trace.SOURCE_LAUNCHPAD, trace.EVENT_NOTE, channel, note, velocity)
                         c = self.COLOR_CODES_FOR_NOTES[(note * 7) % 12] - 2
                         if midi_out:
                             midi_out.play_note(channel, note, velocity)
@@ -278,9 +291,7 @@ class LaunchpadManager:
     def play_note(self, channel, note, velocity):
         note = 60 + ((note + 4) % 12) - 4
         pressed = (velocity != 0)
-        pitch_class = note % 12
-        octave = note // 12
-        print(f"[External Launchpad MIDI Rcv] ({pressed}, {note}, {octave}, {pitch_class}, {velocity})")
+        if trace.recorder: trace.recorder.record(trace.SOURCE_LAUNCHPAD, trace.EVENT_NOTE, channel, note, velocity)
 
         button = self.notes_cache.get(note)
         c = self.COLOR_CODES_FOR_NOTES[(note * 7) % 12] - 2
@@ -324,6 +335,7 @@ class LaunchpadElement(layout.root.LayoutElement):
         self.color = [self.null_color] * self.max_pos
         self.label = ['xx'] * self.max_pos
         self.highlight = [False] * self.max_pos
+        self.version = 0 # Increased whenever a button color changes
 
         height = (self.cols + 1) * self.sq_width + self.cols * self.sq_hgap + self.border_gap * 2
         width  = (self.rows + 1) * self.sq_height + self.rows * self.sq_vgap + self.border_gap * 2
@@ -339,7 +351,8 @@ class LaunchpadElement(layout.root.LayoutElement):
 
         color = self.null_color
         border = (0.5, 0.5, 0.5)
-        note_names = self.music_info.note_names
+        state = self.music_info.state
+        note_names = state.note_names
 
         for button_y in range(self.rows):
             y1 = ypos + (1 + button_y) * (self.sq_height + self.sq_vgap)
@@ -367,7 +380,7 @@ class LaunchpadElement(layout.root.LayoutElement):
                 ctx.stroke()
 
                 #~ label = self.label[button_x + (7 - button_y) * 10]
-                label = note_names[(self.music_info.root_note + self.lp_layout(button_x, 7 - button_y)) % 12]
+                label = note_names[(state.root_note + self.lp_layout(button_x, 7 - button_y)) % 12]
                 ctx.set_source_rgb(0.0 if color[0] >= 0.5 else 1.0, 0.0 if color[1] >= 0.5 else 1.0, 0.0 if color[1] >= 0.5 else 1.0 )
                 ctx.select_font_face("monospace", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
                 ctx.set_font_size(min(self.sq_width, self.sq_height) * 0.6)
@@ -416,3 +429,4 @@ class LaunchpadElement(layout.root.LayoutElement):
             self.color[x + y * 10] = LAUNCHPAD_COLORS[i]
         else:
             self.color[x + y * 10] = self.null_color
+        self.version += 1
@@ -11,6 +11,7 @@ import layout
 import rtmidi
 
 from .colors import hsv_to_rgb
+from . import trace
 
 class KeyboardManager:
     def __init__(self, piano, midi_out=None):
@@ -61,12 +62,10 @@ class KeyboardManager:
         if len(midi_msg) > 2:
             pressed = (midi_msg[2] != 0)
             note = midi_msg[1]
-            pitch_class = midi_msg[1] % 12
-            octave = midi_msg[1] // 12
             channel = 0
             velocity = midi_msg[2]
 
-            print(f"[Piano MIDI Rcv] ({pressed}, {note}, {octave}, {pitch_class}, {velocity})")
+            if trace.recorder: trace.recorder.record(trace.SOURCE_PIANO, trace.EVENT_NOTE, channel, note, velocity)
             if self.piano:
                 self.piano.pressOrReleaseKey(channel, note, pressed)
             if self.midi_out:
@@ -75,10 +74,7 @@ class KeyboardManager:
     # For inputs from MidiRouter
     def play_note(self, channel, note, velocity):
         pressed = (velocity != 0)
-        pitch_class = note % 12
-        octave = note // 12
-
-        print(f"[External Piano MIDI Rcv] ({pressed}, {note}, {octave}, {pitch_class}, {velocity})")
+        if trace.recorder: trace.recorder.record(trace.SOURCE_PIANO, trace.EVENT_NOTE, channel, note, velocity)
         if self.piano:
             self.piano.pressOrReleaseKey(channel, note, pressed)
         if self.midi_out:
@@ -109,6 +105,7 @@ class PianoElement(layout.root.LayoutElement):
 
         max_octaves = 10
         self.keys_pressed = [0] * (12 * max_octaves)
+        self.version = 0 # Increased whenever keys_pressed changes
 
     def get_minimum_size(self, ctx):
         return self.size
@@ -123,9 +120,10 @@ class PianoElement(layout.root.LayoutElement):
         black_key_width = white_key_width * 7. / 12.
         black_key_height = white_key_height * .6
 
-        notes_in_scale = self.music_info.notes_in_scale
-        root_note = self.music_info.root_note % 12
-        note_names = self.music_info.note_names
+        state = self.music_info.state
+        notes_in_scale = state.notes_in_scale
+        root_note = state.root_note % 12
+        note_names = state.note_names
 
         # White Keys
         pos = 0
@@ -240,3 +238,4 @@ class PianoElement(layout.root.LayoutElement):
             self.keys_pressed[num_key] |= (1<<channel)
         else:
             self.keys_pressed[num_key] &= ~(1<<channel)
+        self.version += 1
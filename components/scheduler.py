@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Drift-free playback scheduling. Events are waited for at absolute deadlines on the monotonic clock,
+# so errors don't accumulate from one event to the next and wall clock changes have no effect. The
+# thread sleeps until shortly before the deadline, then spins for the rest, as sleeps are rounded up by
+# the OS timer slack. How late every event was dispatched is kept in a histogram. Waits can be interrupted
+# from another thread, e.g. to seek.
+#
+# Deadlines are given in song time (seconds), and converted to the monotonic clock only when waited for,
+# from an anchor: the song time 'anchor_seconds' was at 'anchor_ns', and the song plays at 'rate' times
+# its speed since then. Changing the rate moves the anchor to the current song time, so the song doesn't
+# jump, and interrupts the wait so that the deadline is converted again.
+
+import time
+import threading
+
+# Sleep until this long before the deadline, then spin (in ns)
+SPIN_NS = 1_000_000
+
+# Lateness histogram: 10 µs bins up to 100 ms, the last bin is for anything later
+LATENESS_BIN_NS = 10_000
+LATENESS_NUM_BINS = 10_000
+
+class LatenessHistogram():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * LATENESS_NUM_BINS
+        self.count = 0
+        self.max_ns = 0
+
+    def add(self, lateness_ns):
+        if lateness_ns < 0:
+            lateness_ns = 0
+        self.counts[min(lateness_ns // LATENESS_BIN_NS, LATENESS_NUM_BINS - 1)] += 1
+        self.count += 1
+        if lateness_ns > self.max_ns:
+            self.max_ns = lateness_ns
+
+    def get_percentile(self, percentile):
+        # Upper edge of the bin of the percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = percentile / 100 * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return min((i + 1) * LATENESS_BIN_NS, self.max_ns) * 1e-9
+        return self.max_ns * 1e-9
+
+    def get_stats(self):
+        # Number of events and p50/p99/max lateness, in seconds
+        return {
+            'count': self.count,
+            'p50':   self.get_percentile(50),
+            'p99':   self.get_percentile(99),
+            'max':   self.max_ns * 1e-9,
+        }
+
+class Scheduler():
+    def __init__(self, spin_ns=SPIN_NS):
+        self.spin_ns = spin_ns
+        self.lock = threading.Lock()
+        # (anchor_ns, anchor_seconds, rate), replaced as a whole
+        self.anchor = (0, 0.0, 1.0)
+        self.lateness = LatenessHistogram()
+        self.interrupted = threading.Event()
+
+    def start(self, delay=0.0):
+        # Song time 0 is 'delay' seconds from now, at the current rate
+        with self.lock:
+            self.anchor = (time.monotonic_ns() + int(delay * 1e9), 0.0, self.anchor[2])
+        self.lateness.reset()
+        self.interrupted.clear()
+
+    def set_position(self, seconds):
+        # Song time 'seconds' is now, e.g. after seeking
+        with self.lock:
+            self.anchor = (time.monotonic_ns(), seconds, self.anchor[2])
+
+    def get_position(self):
+        # Current song time, in seconds
+        anchor_ns, anchor_seconds, rate = self.anchor
+        return anchor_seconds + (time.monotonic_ns() - anchor_ns) * 1e-9 * rate
+
+    def set_rate(self, rate):
+        if rate <= 0:
+            raise ValueError(f"Invalid playback rate: {rate}")
+        with self.lock:
+            now_ns = time.monotonic_ns()
+            anchor_ns, anchor_seconds, old_rate = self.anchor
+            # Before the start of the song, the delay left is kept as it is
+            if now_ns > anchor_ns:
+                anchor_seconds += (now_ns - anchor_ns) * 1e-9 * old_rate
+                anchor_ns = now_ns
+            self.anchor = (anchor_ns, anchor_seconds, rate)
+        self.interrupt()
+
+    def get_rate(self):
+        return self.anchor[2]
+
+    def interrupt(self):
+        self.interrupted.set()
+
+    def get_deadline(self, seconds):
+        anchor_ns, anchor_seconds, rate = self.anchor
+        return anchor_ns + int((seconds - anchor_seconds) / rate * 1e9)
+
+    def wait_until(self, deadline_ns):
+        # Returns the lateness of the wake up, in ns, or None if interrupted
+        remaining_ns = deadline_ns - time.monotonic_ns()
+        if remaining_ns > self.spin_ns:
+            if self.interrupted.wait((remaining_ns - self.spin_ns) * 1e-9):
+                self.interrupted.clear()
+                return None
+        now_ns = time.monotonic_ns()
+        while now_ns < deadline_ns:
+            time.sleep(0) # Let other threads run while spinning
+            now_ns = time.monotonic_ns()
+        lateness_ns = now_ns - deadline_ns
+        self.lateness.add(lateness_ns)
+        return lateness_ns
+
+    def wait(self, seconds):
+        # Waits until song time 'seconds'
+        return self.wait_until(self.get_deadline(seconds))
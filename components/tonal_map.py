@@ -49,8 +49,9 @@ class TonalMapElement(layout.root.LayoutElement):
 
     def render(self, rect, ctx):
         xpos, ypos, width, height = rect.get_data()
-        central_note = self.music_info.root_note
-        notes_in_scale = self.music_info.notes_in_scale
+        state = self.music_info.state
+        central_note = state.root_note
+        notes_in_scale = state.notes_in_scale
 
         cx = xpos + width / 2.
         cy = ypos + height / 2.
@@ -68,7 +69,7 @@ class TonalMapElement(layout.root.LayoutElement):
         for semitone in range(6 * 12):
             diff_n = semitone - 12 * 3 + 1
             note = central_note + diff_n
-            name = self.music_info.note_names[note % 12]
+            name = state.note_names[note % 12]
             px, py = self.getNotePosition(diff_n)
             q.put((note, name, px, -py))
 
@@ -118,7 +119,7 @@ class TonalMapElement(layout.root.LayoutElement):
             x = cx + cang * px + sang * py
             y = cy + cang * py - sang * px
 
-            if self.music_info.keys_pressed[note]:
+            if state.keys_pressed[note]:
                 color = get_color_from_note(note % 12, 1.)
                 ctx.set_line_width(5)
             else:
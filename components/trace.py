@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Low overhead event tracing. Records are packed into a preallocated ring buffer and only decoded
+# offline, so nothing is formatted or printed while playing. When tracing is disabled, 'recorder'
+# is None and callers skip recording with a single check:
+#
+#   if trace.recorder: trace.recorder.record(trace.SOURCE_MIDI_OUTPUT, trace.EVENT_NOTE, channel, note, velocity)
+#
+# Dumped traces can be pretty-printed with: python3 components/trace.py <trace file>
+
+import sys
+import time
+import struct
+import itertools
+
+SOURCE_MUSIC_INFO  = 1
+SOURCE_LAUNCHPAD   = 2
+SOURCE_PIANO       = 3
+SOURCE_MIDI_OUTPUT = 4
+SOURCE_FILE_PLAYER = 5
+
+SOURCE_NAMES = {
+    SOURCE_MUSIC_INFO:  'MusicInfo',
+    SOURCE_LAUNCHPAD:   'Launchpad',
+    SOURCE_PIANO:       'Piano',
+    SOURCE_MIDI_OUTPUT: 'MidiOutput',
+    SOURCE_FILE_PLAYER: 'FilePlayer',
+}
+
+EVENT_NOTE        = 1 # channel, note, velocity
+EVENT_BUTTON      = 2 # velocity = pressed, value = button number
+EVENT_CHORD       = 3 # note = chord root (or NO_NOTE), chord = pitch classes, value = chord signature
+EVENT_FUZZY_CHORD = 4 # chord = fuzzy pitch classes
+EVENT_BEAT        = 5 # note = root of the chord (or NO_NOTE), chord = pitch classes in beat, value = beat number
+EVENT_BAR         = 6 # note = music key (or NO_NOTE), value = bar number
+
+EVENT_NAMES = {
+    EVENT_NOTE:        'note',
+    EVENT_BUTTON:      'button',
+    EVENT_CHORD:       'chord',
+    EVENT_FUZZY_CHORD: 'fuzzy',
+    EVENT_BEAT:        'beat',
+    EVENT_BAR:         'bar',
+}
+
+NO_NOTE = 0xFF
+
+NOTE_NAMES = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B']
+
+# Timestamp (monotonic ns), source, event, channel, note, velocity, chord (12 bits), value
+RECORD = struct.Struct('<qBBBBBHI')
+
+class TraceRecorder():
+    def __init__(self, capacity=65536):
+        self.capacity = 1 << (capacity - 1).bit_length() # Rounded up to a power of two
+        self.mask = self.capacity - 1
+        self.buffer = bytearray(RECORD.size * self.capacity)
+        # next() on itertools.count is atomic, so several threads can record at the same time
+        self.counter = itertools.count()
+
+    def record(self, source, event, channel=0, note=0, velocity=0, chord=0, value=0):
+        pos = (next(self.counter) & self.mask) * RECORD.size
+        RECORD.pack_into(self.buffer, pos, time.monotonic_ns(), source, event, channel, note, velocity, chord & 0xFFFF, value)
+
+    def records(self):
+        # Oldest first. Slots that were never written have a null timestamp.
+        records = [r for r in RECORD.iter_unpack(bytes(self.buffer)) if r[0]]
+        records.sort()
+        return records
+
+    def dump(self, filename):
+        with open(filename, 'wb') as f:
+            for r in self.records():
+                f.write(RECORD.pack(*r))
+
+recorder = None
+
+def enable(capacity=65536):
+    global recorder
+    recorder = TraceRecorder(capacity)
+    return recorder
+
+def disable():
+    global recorder
+    recorder = None
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return list(RECORD.iter_unpack(f.read()))
+
+def format_record(r, start_timestamp=0):
+    timestamp, source, event, channel, note, velocity, chord, value = r
+    note_name = '-' if note == NO_NOTE else f"{NOTE_NAMES[note % 12]}{note // 12 - 1}"
+    text = f"{(timestamp - start_timestamp) / 1e6:12.3f} ms {SOURCE_NAMES.get(source, source):>10} {EVENT_NAMES.get(event, event):>6}"
+    if event == EVENT_NOTE:
+        return text + f" ch={channel:<2} note={note:<3} ({note_name}) vel={velocity}"
+    elif event == EVENT_BUTTON:
+        return text + f" button={value} pressed={velocity != 0}"
+    elif event == EVENT_CHORD:
+        root_name = '-' if note == NO_NOTE else NOTE_NAMES[note % 12]
+        return text + f" {chord:03x} ~ {chord:012b} root={root_name} signature={value:03x}"
+    elif event == EVENT_FUZZY_CHORD:
+        return text + f" {chord:03x} ~ {chord:012b}"
+    elif event == EVENT_BEAT:
+        root_name = '-' if note == NO_NOTE else NOTE_NAMES[note % 12]
+        return text + f" #{value} {chord:03x} ~ {chord:012b} root={root_name}"
+    elif event == EVENT_BAR:
+        key_name = '-' if note == NO_NOTE else f"{NOTE_NAMES[note % 12]}:{['Maj', 'min'][note // 12]}"
+        return text + f" #{value} key={key_name}"
+    return text + f" ch={channel} note={note} vel={velocity} chord={chord:03x} value={value}"
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <trace file>")
+        sys.exit(1)
+    records = load(sys.argv[1])
+    start_timestamp = records[0][0] if records else 0
+    for r in records:
+        print(format_record(r, start_timestamp))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Headless batch analysis of a MIDI corpus: runs the MidiFileSoundPlayer.load_file analysis (bars, beats,
+# music keys, chords) over many files with a process pool, and streams the results to an output directory
+# as they come, in .npz parts of a few hundred files with one column per field. The rows of file n of a
+# part are bar_offsets[n]:bar_offsets[n+1] in the bar columns and beat_offsets[n]:beat_offsets[n+1] in the
+# beat columns. load_results() joins all the parts in the same layout.
+#
+#   python3 key_finding_batch.py -o keys ~/midi/
+
+import os
+import sys
+import time
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from components.midi_file_player import MidiFileSoundPlayer
+from components.hmm_key_finding import load_key_finding_parameters
+
+MIDI_FILE_EXTENSIONS = ('.mid', '.midi', '.kar')
+
+# Number of files saved in every part of the output
+DEFAULT_FILES_PER_PART = 256
+
+BAR_COLUMNS = {
+    'bar_ticks':                    np.int64,
+    'music_key_per_bar':            np.int8,
+    'music_key_confidence_per_bar': np.float32,
+}
+
+BEAT_COLUMNS = {
+    'beat_ticks':          np.int64,
+    'chord_type_per_beat': np.int16,
+    'chord_note_per_beat': np.int8,
+}
+
+def find_midi_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith(MIDI_FILE_EXTENSIONS):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+def analyse_file(filename, key_finding_parameters=None):
+    # Runs in a worker process. Returns the columns of the file, or the error message
+    try:
+        player = MidiFileSoundPlayer(key_finding_parameters=key_finding_parameters)
+        player.load_file(filename, verbose=False)
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}"
+
+    num_bars = len(player.music_key_per_bar)
+    columns = {
+        'ticks_per_beat':               player.ticks_per_beat,
+        'bar_ticks':                    player.bar_ticks[:num_bars],
+        'music_key_per_bar':            player.music_key_per_bar,
+        'music_key_confidence_per_bar': player.music_key_confidence_per_bar,
+        'beat_ticks':                   player.beat_ticks,
+        'chord_type_per_beat':          player.chord_type_per_beat,
+        'chord_note_per_beat':          player.chord_note_per_beat,
+    }
+    return filename, columns, None
+
+class ResultWriter():
+    # Collects the columns of the files analysed and saves them every 'files_per_part' files, so that memory
+    # does not grow with the corpus and an interrupted run keeps the parts already saved
+    def __init__(self, output, files_per_part=DEFAULT_FILES_PER_PART):
+        self.output = output
+        self.files_per_part = files_per_part
+        self.num_parts = 0
+        self.num_files = 0
+        self.num_errors = 0
+        self.num_bars = 0
+        self.num_beats = 0
+        os.makedirs(output, exist_ok=True)
+        self._clear()
+
+    def _clear(self):
+        self.files = []
+        self.errors = []
+        self.ticks_per_beat = []
+        self.bar_offsets = [0]
+        self.beat_offsets = [0]
+        self.bar_columns = {name: [] for name in BAR_COLUMNS}
+        self.beat_columns = {name: [] for name in BEAT_COLUMNS}
+
+    def add(self, filename, columns, error):
+        self.files.append(filename)
+        if columns is None:
+            self.errors.append(error)
+            self.ticks_per_beat.append(0)
+            self.bar_offsets.append(self.bar_offsets[-1])
+            self.beat_offsets.append(self.beat_offsets[-1])
+            self.num_errors += 1
+        else:
+            self.errors.append('')
+            self.ticks_per_beat.append(columns['ticks_per_beat'])
+            for name, dtype in BAR_COLUMNS.items():
+                self.bar_columns[name].append(np.asarray(columns[name], dtype=dtype))
+            for name, dtype in BEAT_COLUMNS.items():
+                self.beat_columns[name].append(np.asarray(columns[name], dtype=dtype))
+            self.bar_offsets.append(self.bar_offsets[-1] + len(columns['music_key_per_bar']))
+            self.beat_offsets.append(self.beat_offsets[-1] + len(columns['beat_ticks']))
+        self.num_files += 1
+        if len(self.files) >= self.files_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self.files:
+            return
+        output = {
+            'files':          np.array(self.files),
+            'errors':         np.array(self.errors),
+            'ticks_per_beat': np.array(self.ticks_per_beat, dtype=np.int32),
+            'bar_offsets':    np.array(self.bar_offsets, dtype=np.int64),
+            'beat_offsets':   np.array(self.beat_offsets, dtype=np.int64),
+        }
+        for name, dtype in BAR_COLUMNS.items():
+            output[name] = np.concatenate(self.bar_columns[name]) if self.bar_columns[name] else np.zeros(0, dtype=dtype)
+        for name, dtype in BEAT_COLUMNS.items():
+            output[name] = np.concatenate(self.beat_columns[name]) if self.beat_columns[name] else np.zeros(0, dtype=dtype)
+
+        # Written under another name first, so that a part is either complete or missing
+        filename = os.path.join(self.output, f"part-{self.num_parts:05d}.npz")
+        temp_filename = filename + '.tmp.npz'
+        np.savez_compressed(temp_filename, **output)
+        os.replace(temp_filename, filename)
+
+        self.num_parts += 1
+        self.num_bars += self.bar_offsets[-1]
+        self.num_beats += self.beat_offsets[-1]
+        self._clear()
+
+def load_results(output):
+    # All the parts saved by ResultWriter in one set of columns, with the offsets of every file
+    results = {}
+    for file_name in sorted(os.listdir(output)):
+        if file_name.startswith('part-') and file_name.endswith('.npz') and not file_name.endswith('.tmp.npz'):
+            with np.load(os.path.join(output, file_name)) as part:
+                for name in part.files:
+                    column = part[name]
+                    if name in ('bar_offsets', 'beat_offsets'):
+                        previous = results.get(name)
+                        column = column if previous is None else previous[-1][-1] + column[1:]
+                    results.setdefault(name, []).append(column)
+    return {name: np.concatenate(columns) for name, columns in results.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the music keys of a MIDI corpus")
+    parser.add_argument('paths', help="MIDI files, or directories to search for MIDI files", nargs='+')
+    parser.add_argument('-o', '--output', help="Output directory", dest='output', default="music_keys")
+    parser.add_argument('-p', '--parameters', help="Key finding parameters, as saved by key_finding_train.py", dest='parameters', default=None)
+    parser.add_argument('-j', '--jobs', help="Number of worker processes (default: one per CPU)", dest='jobs', type=int, default=None)
+    parser.add_argument('-n', '--files-per-part', help=f"Number of files saved in every part of the output (default: {DEFAULT_FILES_PER_PART})", dest='files_per_part', type=int, default=DEFAULT_FILES_PER_PART)
+    parser.add_argument('-v', "--verbose", dest='verbose', action="count", default=0)
+    args = parser.parse_args()
+
+    filenames = list(find_midi_files(args.paths))
+    if not filenames:
+        sys.exit("No MIDI files found")
+
+    key_finding_parameters = load_key_finding_parameters(args.parameters) if args.parameters else None
+
+    writer = ResultWriter(args.output, args.files_per_part)
+
+    num_jobs = args.jobs or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+        # Results are collected in order as soon as they are ready
+        chunksize = max(1, min(32, len(filenames) // (8 * num_jobs)))
+        for num_file, (filename, columns, error) in enumerate(executor.map(analyse_file, filenames, [key_finding_parameters] * len(filenames), chunksize=chunksize)):
+            writer.add(filename, columns, error)
+            if columns is None:
+                print(f"{filename}: {error}", file=sys.stderr)
+
+            if args.verbose:
+                elapsed_time = time.perf_counter() - start_time
+                print(f"[{num_file + 1}/{len(filenames)}] {filename} ({(num_file + 1) / elapsed_time:.1f} files/s)")
+    writer.flush()
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print(f"Analysed {writer.num_files} files ({writer.num_errors} failed) in {elapsed_time:.2f} s: {writer.num_files / elapsed_time:.1f} files/s")
+    print(f"{writer.num_bars} bars and {writer.num_beats} beats saved to {writer.num_parts} parts in '{args.output}'")
+
+if __name__ == "__main__":
+    main()
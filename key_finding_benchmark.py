@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Speed and accuracy benchmark of the key finding HMM. Synthetic songs are generated from the model
+# itself: a sequence of keys that changes with probability 1 - prob_same_state at every bar, and for
+# every bar the pitch classes played (12-bit set) and the number of notes of every pitch class. Each
+# stage (emissions, decoders, end-to-end key finding) is timed for every song length, and the keys found
+# are compared with the real ones.
+#
+#   python3 key_finding_benchmark.py --sizes 10 1000 1000000 -o benchmark.json
+
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from components.hmm_key_finding import NUM_MODES, NUM_NOTES, KEY_MODEL_COUNTS, get_key_finding_model, \
+    viterbi_log, viterbi_structured, forward_backward_log, find_music_key, find_music_key_from_counts
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+# The dense decoders are O(T·M²), so they are skipped for the longest songs unless asked for
+MAX_DENSE_SIZE = 100000
+
+def generate_song(num_bars, rng, prob_same_state=0.8, notes_per_bar=8):
+    # Returns the keys, pitch class sets and pitch class counts of every bar
+    num_states = NUM_MODES * NUM_NOTES
+    key_changes = rng.random(num_bars) >= prob_same_state
+    key_changes[0] = True
+    segment_keys = rng.integers(0, num_states, np.count_nonzero(key_changes))
+    keys = segment_keys[np.cumsum(key_changes) - 1]
+
+    a, b = get_key_finding_model()
+    frequencies = np.array([np.roll(b.data[mode][:12], note) for mode in range(NUM_MODES) for note in range(NUM_NOTES)])
+    pitch_classes = (rng.random((num_bars, 12)) < frequencies[keys]) @ (1 << np.arange(12))
+
+    a, b = get_key_finding_model(model=KEY_MODEL_COUNTS)
+    profiles = np.exp(b.get_log_profiles())
+    pitch_counts = rng.multinomial(notes_per_bar, profiles[keys])
+
+    return keys, pitch_classes, pitch_counts
+
+def best_time(function, repeat):
+    # Best of 'repeat' runs, and the result of the last one
+    times = []
+    for n in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+def benchmark(num_bars, rng, repeat, dense):
+    keys, pitch_classes, pitch_counts = generate_song(num_bars, rng)
+    num_states = NUM_MODES * NUM_NOTES
+    initial_distribution = np.array([1. / num_states] * num_states)
+    log_initial_distribution = np.log(initial_distribution)
+
+    a, b = get_key_finding_model()
+    count_a, count_b = get_key_finding_model(model=KEY_MODEL_COUNTS)
+    b.get_log_table() # Loaded once, like in the player
+    log_a = a.get_log_matrix()
+
+    results = {'bars': num_bars}
+    timings = {}
+
+    timings['emissions_masks'], log_b = best_time(lambda: np.ascontiguousarray(b.get_log_table()[:, pitch_classes].T), repeat)
+    timings['emissions_counts'], count_log_b = best_time(lambda: count_b.get_log_emissions(pitch_counts), repeat)
+    timings['viterbi_structured'], states = best_time(lambda: viterbi_structured(log_b, a, log_initial_distribution), repeat)
+    if dense:
+        timings['viterbi_dense'], dense_states = best_time(lambda: viterbi_log(log_b, log_a, log_initial_distribution), repeat)
+        results['dense_matches_structured'] = bool(np.array_equal(states, dense_states))
+        timings['forward_backward'], posteriors = best_time(lambda: forward_backward_log(log_b, log_a, initial_distribution), repeat)
+    timings['find_music_key'], found_keys = best_time(lambda: find_music_key(pitch_classes), repeat)
+    timings['find_music_key_from_counts'], found_count_keys = best_time(lambda: find_music_key_from_counts(pitch_counts), repeat)
+
+    results['seconds'] = timings
+    results['bars_per_second'] = {name: num_bars / seconds if seconds else None for name, seconds in timings.items()}
+    results['accuracy'] = {
+        'masks':  float(np.mean(np.array(found_keys) == keys)),
+        'counts': float(np.mean(np.array(found_count_keys) == keys)),
+    }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the speed and accuracy of key finding")
+    parser.add_argument('-s', '--sizes', help="Song lengths, in bars", dest='sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('-r', '--repeat', help="Number of runs of every stage (the best one is kept)", dest='repeat', type=int, default=3)
+    parser.add_argument('-d', '--dense', help="Also time the dense decoders on the longest songs", dest='dense', action='store_true')
+    parser.add_argument('--seed', help="Random seed", dest='seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="Save the results to this JSON file", dest='output', default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    all_results = []
+    for num_bars in args.sizes:
+        results = benchmark(num_bars, rng, args.repeat, args.dense or num_bars <= MAX_DENSE_SIZE)
+        all_results.append(results)
+
+        print(f"{num_bars} bars:")
+        for name, seconds in results['seconds'].items():
+            print(f"  {name:<28} {seconds * 1e3:12.3f} ms {results['bars_per_second'][name]:14.0f} bars/s")
+        print(f"  accuracy: masks = {results['accuracy']['masks']:.3f}, counts = {results['accuracy']['counts']:.3f}")
+        if 'dense_matches_structured' in results and not results['dense_matches_structured']:
+            print("  WARNING: the dense and structured decoders found different keys")
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'seed': args.seed, 'repeat': args.repeat, 'results': all_results}, f, indent=4)
+        print(f"Results saved to '{args.output}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Baum-Welch (EM) training of the key finding HMM parameters from a MIDI corpus: the profiles of the
+# major and minor modes, and the probability of staying in the same key from one bar to the next.
+# E-steps run in parallel over the files with a process pool. The parameters are saved as JSON, to
+# be loaded with hmm_key_finding.load_key_finding_parameters.
+#
+#   python3 key_finding_train.py -o key_parameters.json ~/midi/
+
+import os
+import sys
+import time
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from components.midi_file_player import MidiFileSoundPlayer
+from components.hmm_key_finding import KEY_MODEL_MASKS, KEY_MODEL_COUNTS, NUM_MODES, NUM_NOTES, \
+    get_key_finding_model, baum_welch_statistics, save_key_finding_parameters
+from key_finding_batch import find_midi_files
+
+# Profiles are kept away from 0 (and from 1 for the masks model), so that no key becomes impossible
+MIN_PROFILE_VALUE = 1e-3
+
+# Degree d of the scale of root note r is pitch class (r + d) % 12
+PITCH_CLASS_OF_DEGREE = (np.arange(NUM_NOTES)[:, None] + np.arange(12)) % 12
+
+# Observations of every file, set in every worker process by init_worker
+observations = None
+
+def load_observations(filename):
+    try:
+        player = MidiFileSoundPlayer()
+        player.load_file(filename, verbose=False)
+    except Exception as e:
+        return filename, None, f"{type(e).__name__}: {e}"
+    return filename, (player.pitch_counts_per_bar, player.pitch_classes_per_bar), None
+
+def init_worker(all_observations):
+    global observations
+    observations = all_observations
+
+def e_step(parameters, file_indices):
+    # Expected statistics of a group of files, summed
+    a, b = get_key_finding_model(parameters, parameters['model'])
+    log_a = a.get_log_matrix()
+    initial_distribution = np.array([1. / (NUM_MODES * NUM_NOTES)] * NUM_MODES * NUM_NOTES)
+
+    profile_stats = np.zeros((NUM_MODES, 12))
+    mode_stats = np.zeros(NUM_MODES)
+    transition_stats = np.zeros(2) # Staying in the same key, all the transitions
+    log_likelihood = 0.
+    for num_file in file_indices:
+        pitch_counts, pitch_classes = observations[num_file]
+        if parameters['model'] == KEY_MODEL_COUNTS:
+            log_b = b.get_log_emissions(pitch_counts)
+            values = pitch_counts.astype(np.float64)
+        else:
+            log_b = b.get_log_emissions(pitch_classes)
+            values = ((pitch_classes.astype(np.int64)[:, None] >> np.arange(12)) & 1).astype(np.float64)
+
+        posteriors, transitions, file_log_likelihood = baum_welch_statistics(log_b, log_a, initial_distribution)
+
+        # Σt γt(mode, root) · value of the degree d of the scale of root, for every mode and degree
+        posteriors = posteriors.reshape(-1, NUM_MODES, NUM_NOTES)
+        profile_stats += np.einsum('tmr,trd->md', posteriors, values[:, PITCH_CLASS_OF_DEGREE])
+        mode_stats += np.sum(posteriors, axis=(0, 2))
+        transition_stats += [np.trace(transitions), np.sum(transitions)]
+        log_likelihood += file_log_likelihood
+
+    return profile_stats, mode_stats, transition_stats, log_likelihood
+
+def m_step(model, profile_stats, mode_stats, transition_stats, parameters):
+    if model == KEY_MODEL_COUNTS:
+        # Multinomial: share of the notes played on every degree
+        profiles = profile_stats / np.maximum(np.sum(profile_stats, axis=1, keepdims=True), 1e-300)
+        profiles = np.maximum(profiles, MIN_PROFILE_VALUE)
+        profiles /= np.sum(profiles, axis=1, keepdims=True)
+    else:
+        # Bernoulli: how often every degree is present in a bar
+        profiles = profile_stats / np.maximum(mode_stats[:, None], 1e-300)
+        profiles = np.clip(profiles, MIN_PROFILE_VALUE, 1. - MIN_PROFILE_VALUE)
+
+    prob_same_state = parameters['prob_same_state']
+    if transition_stats[1] > 0:
+        prob_same_state = float(np.clip(transition_stats[0] / transition_stats[1], MIN_PROFILE_VALUE, 1. - MIN_PROFILE_VALUE))
+
+    return dict(parameters, prob_same_state=prob_same_state, profile_major=profiles[0].tolist(), profile_minor=profiles[1].tolist())
+
+def get_initial_parameters(model):
+    a, b = get_key_finding_model(None, model)
+    if model == KEY_MODEL_COUNTS:
+        profiles = b.profiles
+    else:
+        profiles = np.array([b.data[mode][:12] for mode in range(NUM_MODES)])
+    return {
+        'model': model,
+        'prob_same_state': a.prob_same_state,
+        'profile_major': list(map(float, profiles[0])),
+        'profile_minor': list(map(float, profiles[1])),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the key finding HMM parameters on a MIDI corpus")
+    parser.add_argument('paths', help="MIDI files, or directories to search for MIDI files", nargs='+')
+    parser.add_argument('-o', '--output', help="Output parameter file", dest='output', default="key_parameters.json")
+    parser.add_argument('-m', '--model', help="Emission model", dest='model', choices=[KEY_MODEL_COUNTS, KEY_MODEL_MASKS], default=KEY_MODEL_COUNTS)
+    parser.add_argument('-n', '--iterations', help="Maximum number of EM iterations", dest='iterations', type=int, default=50)
+    parser.add_argument('-e', '--tolerance', help="Stop when the log likelihood per bar improves less than this", dest='tolerance', type=float, default=1e-4)
+    parser.add_argument('-j', '--jobs', help="Number of worker processes (default: one per CPU)", dest='jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    filenames = list(find_midi_files(args.paths))
+    if not filenames:
+        sys.exit("No MIDI files found")
+
+    num_jobs = args.jobs or os.cpu_count() or 1
+    start_time = time.perf_counter()
+
+    all_observations = []
+    with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+        chunksize = max(1, min(32, len(filenames) // (8 * num_jobs)))
+        for filename, file_observations, error in executor.map(load_observations, filenames, chunksize=chunksize):
+            if error:
+                print(f"{filename}: {error}", file=sys.stderr)
+            elif len(file_observations[0]):
+                all_observations.append(file_observations)
+
+    num_bars = sum(len(pitch_counts) for pitch_counts, pitch_classes in all_observations)
+    if not num_bars:
+        sys.exit("No bars found")
+    print(f"Loaded {len(all_observations)} files ({num_bars} bars) in {time.perf_counter() - start_time:.2f} s")
+
+    # Every worker keeps all the observations, and gets a group of files to process at every iteration
+    groups = [group for group in np.array_split(np.arange(len(all_observations)), num_jobs * 4) if len(group)]
+    parameters = get_initial_parameters(args.model)
+    last_log_likelihood = None
+    with ProcessPoolExecutor(max_workers=num_jobs, initializer=init_worker, initargs=(all_observations,)) as executor:
+        for iteration in range(args.iterations):
+            profile_stats = np.zeros((NUM_MODES, 12))
+            mode_stats = np.zeros(NUM_MODES)
+            transition_stats = np.zeros(2)
+            log_likelihood = 0.
+            for stats in executor.map(e_step, [parameters] * len(groups), groups):
+                profile_stats += stats[0]
+                mode_stats += stats[1]
+                transition_stats += stats[2]
+                log_likelihood += stats[3]
+
+            print(f"Iteration {iteration + 1}: log likelihood per bar = {log_likelihood / num_bars:.6f}, prob_same_state = {parameters['prob_same_state']:.4f} ({time.perf_counter() - start_time:.2f} s)")
+            if last_log_likelihood is not None and (log_likelihood - last_log_likelihood) / num_bars < args.tolerance:
+                break
+            last_log_likelihood = log_likelihood
+
+            parameters = m_step(args.model, profile_stats, mode_stats, transition_stats, parameters)
+
+    parameters['num_files'] = len(all_observations)
+    parameters['num_bars'] = num_bars
+    save_key_finding_parameters(args.output, parameters)
+    print(f"Parameters saved to '{args.output}' in {time.perf_counter() - start_time:.2f} s")
+
+if __name__ == "__main__":
+    main()
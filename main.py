@@ -15,6 +15,7 @@ import argparse
 
 from threading import Thread, Lock
 
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Rsvg
 
@@ -40,6 +41,7 @@ from components.music_staff        import MusicStaffElement
 from components.midi_file_player   import MidiFileSoundPlayer
 
 import components.fluidsynth as fluidsynth
+import components.trace as trace
 
 
 #~ def trace(frame, event, arg):
@@ -105,9 +107,12 @@ class ImageElement(layout.root.LayoutElement):
         xpos, ypos, width, height = rect.get_data()
 
 class MainWindow(Gtk.Window):
-    def __init__(self, elements):
+    def __init__(self, elements, sources=()):
         super(MainWindow, self).__init__()
         self.elements = elements
+        # Objects with a 'version' attribute that changes whenever what they show changes
+        self.sources = sources
+        self.drawn_versions = None
 
         min_width, min_height = 0, 0
         for element in  self.elements:
@@ -131,6 +136,16 @@ class MainWindow(Gtk.Window):
         self.connect("delete-event", Gtk.main_quit)
         self.show_all()
 
+        GLib.timeout_add(50, self.on_timeout)
+
+    def on_timeout(self):
+        # Only redraw when something has changed since the last frame
+        versions = tuple(source.version for source in self.sources)
+        if versions != self.drawn_versions:
+            self.drawn_versions = versions
+            self.queue_draw()
+        return True
+
     def on_draw(self, wid, cr):
         #~ cr.set_source_rgb(0, 0, 0)
         #~ cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
@@ -145,8 +160,6 @@ class MainWindow(Gtk.Window):
             cr.save()
             element.render(self.rect, cr)
             cr.restore()
-        time.sleep(0.05)
-        self.queue_draw()
 
 class MidiRouter:
     def __init__(self):
@@ -165,6 +178,10 @@ class MidiRouter:
             destination, new_channel = port_data
             destination.play_note(new_channel, note, velocity)
 
+    def play_notes(self, events):
+        for channel, note, velocity in events:
+            self.play_note(channel, note, velocity)
+
     def change_program(self, channel, program):
         port_data = self.ports.get(channel)
         if port_data:
@@ -232,16 +249,26 @@ class MidiOutput:
             duration = self.random_duration(mean_duration)
             self.press(key, velocity, duration)
 
-    def play_note(self, channel, note, velocity):
-        print(f"[MIDI Output] ({channel}, {note}, {velocity})")
+    def _output_note(self, channel, note, velocity):
+        # Sound output of a single note event, shared by play_note and play_notes
+        if trace.recorder: trace.recorder.record(trace.SOURCE_MIDI_OUTPUT, trace.EVENT_NOTE, channel, note, velocity)
         if velocity > 0:
             self.fs.noteon(channel, note, velocity)
         else:
             self.fs.noteoff(channel, note)
 
+    def play_note(self, channel, note, velocity):
+        self._output_note(channel, note, velocity)
+
         for element in self.elements:
             element.playNote(channel, note, velocity)
 
+    def play_notes(self, events):
+        for channel, note, velocity in events:
+            self._output_note(channel, note, velocity)
+
+        for element in self.elements:
+            element.play_notes(events)
 
     def change_program(self, channel, program):
         self.channel_programs[channel] = program
@@ -278,7 +305,10 @@ def main():
     parser.add_argument('-l', '--layout', help="Launchpad Layout", dest='layout', default="III_iii")
     parser.add_argument('-e', '--event-device', help="Input keyboard device", dest='evdev', action='append', nargs='+')
     parser.add_argument('-f', '--file', help="Play MIDI file", dest='file', default=None)
+    parser.add_argument('-r', '--rate', help="Playback speed of the MIDI file (e.g. 0.5 for half speed)", dest='rate', type=float, default=1.0)
     parser.add_argument('-i', '--info', help="Print info", dest='info', action='store_true')
+    parser.add_argument('-t', '--trace', help="Record a trace of the MIDI events and dump it to this file on exit", dest='trace', default=None)
+    parser.add_argument('-k', '--key-tracking', help="Detect the music key while playing, from the notes of every window of this many seconds", dest='key_window', type=float, default=None)
     parser.add_argument('-v', "--verbose", dest='verbose', action="count", default=0)
     args = parser.parse_args()
 
@@ -289,8 +319,13 @@ def main():
         printInfo()
         sys.exit(0)
 
+    if args.trace:
+        trace.enable()
+
     music_info = MusicalInfo()
     music_info.start()
+    if args.key_window:
+        music_info.start_key_tracking(args.key_window)
 
     piano = PianoElement(music_info)
     lpad = LaunchpadElement(music_info, LAUNCHPAD_LAYOUTS[args.layout])
@@ -309,7 +344,7 @@ def main():
     box.right = cfifths
     box.margin = 1
 
-    window = MainWindow([box])
+    window = MainWindow([box], [music_info, piano, lpad])
 
     midi_out = MidiOutput(args.port_name, [music_info])
 
@@ -340,6 +375,7 @@ def main():
     if args.file:
         midi_file_player = MidiFileSoundPlayer(midi_file_out)
         midi_file_player.load_file(args.file)
+        midi_file_player.set_rate(args.rate)
         midi_file_player_thread = Thread(target = midi_file_player.play)
         midi_file_player_thread.start()
 
@@ -354,5 +390,13 @@ def main():
 
     print("All threads finished")
 
+    if midi_file_player:
+        stats = midi_file_player.get_lateness_stats()
+        print(f"~ Playback lateness of {stats['count']} events: p50 = {stats['p50'] * 1e3:.3f} ms, p99 = {stats['p99'] * 1e3:.3f} ms, max = {stats['max'] * 1e3:.3f} ms")
+
+    if args.trace:
+        trace.recorder.dump(args.trace)
+        print(f"~ Trace saved to '{args.trace}'")
+
 if __name__ == "__main__":    
     main()